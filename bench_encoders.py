@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Micro-benchmarks of the per-formula encoding steps, on formulas from the
+seeded generator (mathgen.MathMLGenerator).
+
+    python bench_encoders.py -n 500 --save baseline.json
+    python bench_encoders.py --compare baseline.json
+
+Cases (run one formula at a time, inputs prepared beforehand):
+
+    presentation.ordered_paths    get_ordered_paths_and_sisters
+    presentation.unordered_paths  get_unordered_paths
+    presentation.paths            get_paths (ordered and unordered paths and
+                                  sisters in one walk)
+    content.tree                  MathMLContent.encode_mathml_as_tree
+    content.paths                 MathMLContent.encode_paths
+    content.unordered_paths       MathMLContent.get_unordered_paths
+    content.all_paths             MathMLContent.encode_all_paths (ordered and
+                                  unordered paths in one walk)
+    hash.subtree, hash.sigure, hash.modular
+                                  hash_mml of each module, on the presentation
+                                  and content trees (minidom, parsed once)
+    hash.fused                    hashing.hash_etree
+
+For every case the table gives the calls, the throughput (calls per
+second), the p50/p90/p99 latency of a call, and the objects it leaves
+allocated (gc-tracked objects per call, outputs included; python 2 has no
+allocation tracer). The outputs of the first round are digested.
+
+--save writes the generator options, the digests and the measures to a
+JSON file. --compare regenerates the same formulas, and fails (exit status
+1) if an output digest differs, i.e. an optimized path does not give the
+current outputs, or if a p50 latency is more than --tolerance above the
+baseline. Compare on the same machine as the baseline.
+
+--check runs no timings: it compares the outputs of the one-walk cases with
+their reference implementations, input by input, and fails if one differs:
+
+    presentation.paths    get_ordered_paths_and_sisters and get_unordered_paths
+    content.all_paths     encode_paths and get_unordered_paths
+    hash.fused            subtree, sigure and modular hash_mml
+
+    python bench_encoders.py -n 2000 --seed 3 --check
+'''
+import argparse
+import fnmatch
+import gc
+import hashlib
+import json
+import sys
+import timeit
+from xml.dom import minidom
+from lxml import etree
+
+import subtree
+import sigure
+import modular
+import hashing
+from mathgen import MathMLGenerator
+from mathml_presentation_nosnuggle import MathMLPresentation
+from mathml_content import MathMLContent
+
+def percentile(values, p):
+    '''
+    values : sorted list.
+    '''
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))] if values else 0.0
+
+def prepare(mathmls):
+    '''
+    return the cases as (name, function, inputs, reference), reference giving the
+    expected output of function for an input, or None
+    '''
+    procPres = MathMLPresentation('')
+    procCont = MathMLContent()
+    parser = etree.XMLParser(remove_blank_text=True, huge_tree=True)
+    roots, opaths, trees, ooperargs, strings = [], [], [], [], []
+    for mathml in mathmls:
+        root, proper, presentation = procPres.get_doc_with_orig(mathml)
+        if root is not None:
+            roots.append(root)
+            opaths.append(procPres.get_ordered_paths_and_sisters(root, False)[0])
+            strings.append(presentation)
+        ctrees, cmathmls = procCont.encode_mathml_as_tree(mathml)
+        trees.extend(ctrees)
+        strings.extend(cmathmls)
+        for tree in ctrees:
+            ooperargs.extend(procCont.encode_paths(tree))
+    doms = [minidom.parseString(string) for string in strings]
+    elems = [etree.fromstring(string, parser) for string in strings]
+    modular_hash = modular.hash_mml_generator(hashing.MODULAR_DUP_PARAM)
+    elem_doms = dict((id(elem), dom) for elem, dom in zip(elems, doms))
+
+    def reference_paths(root):
+        opaths, sisters = procPres.get_ordered_paths_and_sisters(root, False)
+        return opaths, procPres.get_unordered_paths(opaths), sisters
+
+    def reference_all_paths(tree):
+        ooper, oarg = procCont.encode_paths(tree)
+        return ooper, oarg, procCont.get_unordered_paths(ooper), procCont.get_unordered_paths(oarg)
+
+    def reference_hash(elem):
+        dom = elem_doms[id(elem)]
+        return subtree.hash_mml(dom), sigure.hash_mml(dom), modular_hash(dom)
+
+    return [
+        ('presentation.ordered_paths', lambda root: procPres.get_ordered_paths_and_sisters(root, False), roots, None),
+        ('presentation.unordered_paths', procPres.get_unordered_paths, opaths, None),
+        ('presentation.paths', lambda root: procPres.get_paths(root, False), roots, reference_paths),
+        ('content.tree', procCont.encode_mathml_as_tree, mathmls, None),
+        ('content.paths', procCont.encode_paths, trees, None),
+        ('content.unordered_paths', procCont.get_unordered_paths, ooperargs, None),
+        ('content.all_paths', procCont.encode_all_paths, trees, reference_all_paths),
+        ('hash.subtree', subtree.hash_mml, doms, None),
+        ('hash.sigure', sigure.hash_mml, doms, None),
+        ('hash.modular', modular_hash, doms, None),
+        ('hash.fused', hashing.hash_etree, elems, reference_hash),
+    ]
+
+def selected(name, patterns):
+    return not patterns or any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def run_case(function, inputs, rounds):
+    '''
+    return the measures of function over inputs, and the digest of its outputs
+    '''
+    timer = timeit.default_timer
+    latencies = []
+    digest = hashlib.sha1()
+    outputs = []
+    gc.collect()
+    gc.disable()
+    try:
+        objects = len(gc.get_objects())
+        for value in inputs:
+            start = timer()
+            output = function(value)
+            latencies.append(timer() - start)
+            outputs.append(output)
+        objects = len(gc.get_objects()) - objects
+    finally:
+        gc.enable()
+    for output in outputs:
+        digest.update(repr(output))
+    del outputs
+    for i in range(1, rounds):
+        for value in inputs:
+            start = timer()
+            function(value)
+            latencies.append(timer() - start)
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'calls': len(latencies),
+        'per_second': len(latencies) / total if total else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'objects_per_call': float(objects) / len(inputs) if inputs else 0.0,
+        'digest': digest.hexdigest(),
+    }
+
+def run(options, rounds, patterns):
+    generator = MathMLGenerator(options['seed'], options['max_depth'], options['max_fanout'])
+    cases = prepare(generator.formulas(options['n']))
+    results = {}
+    for name, function, inputs, reference in cases:
+        if not selected(name, patterns):
+            continue
+        results[name] = run_case(function, inputs, rounds)
+        print '%-30s %7d %12.1f %9.3f %9.3f %9.3f %10.1f  %s' % (name, results[name]['calls'], results[name]['per_second'],
+            results[name]['p50_ms'], results[name]['p90_ms'], results[name]['p99_ms'], results[name]['objects_per_call'], results[name]['digest'][:8])
+        sys.stdout.flush()
+    return results
+
+def check(options, patterns):
+    '''
+    return the number of inputs whose output differs from the reference implementation
+    '''
+    generator = MathMLGenerator(options['seed'], options['max_depth'], options['max_fanout'])
+    cases = prepare(generator.formulas(options['n']))
+    failures = 0
+    for name, function, inputs, reference in cases:
+        if reference is None or not selected(name, patterns):
+            continue
+        differ = 0
+        for i, value in enumerate(inputs):
+            output, expected = function(value), reference(value)
+            if list(output) != list(expected):
+                if differ == 0:
+                    print '%s: input %d gives %r, reference %r' % (name, i, output, expected)
+                differ += 1
+        print '%-30s %7d inputs %7d differ' % (name, len(inputs), differ)
+        sys.stdout.flush()
+        failures += differ
+    return failures
+
+def compare(results, baseline, tolerance):
+    '''
+    return the number of regressions against baseline
+    '''
+    failures = 0
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['digest'] != base['digest']:
+            failures += 1
+            print '%s: outputs differ from the baseline' % name
+        if result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            failures += 1
+            print '%s: p50 %.3f ms, baseline %.3f ms' % (name, result['p50_ms'], base['p50_ms'])
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the encoders on synthetic formulas.')
+    parser.add_argument('-n', type=int, default=500, help='number of formulas')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--max-fanout', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3, help='times each case runs over its inputs')
+    parser.add_argument('--cases', nargs='+', metavar='PATTERN', help='run the matching cases only (e.g. hash.*)')
+    parser.add_argument('--save', metavar='FILE', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='check the results against a baseline, with its generator options')
+    parser.add_argument('--check', action='store_true', help='compare the outputs with the reference implementations instead of timing')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 slowdown over the baseline (0.25: 25%%)')
+    args = parser.parse_args()
+    options = dict(n=args.n, seed=args.seed, max_depth=args.max_depth, max_fanout=args.max_fanout)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        options = baseline['options']
+    if args.check:
+        failures = check(options, args.cases)
+        print '%d differences' % failures
+        sys.exit(1 if failures else 0)
+    print '%-30s %7s %12s %9s %9s %9s %10s  %s' % ('case', 'calls', 'calls/s', 'p50 ms', 'p90 ms', 'p99 ms', 'objs/call', 'digest')
+    results = run(options, args.rounds, args.cases)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=1, sort_keys=True)
+    if baseline is not None:
+        failures = compare(results, baseline['results'], args.tolerance)
+        print '%d regressions' % failures
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Benchmark of the presentation tree normalization on long formulas.
+
+    python bench_normalize.py
+    python bench_normalize.py --sizes 100 1000 10000 --repeat 20
+
+Compares the single in-place pass of MathMLPresentation.get_doc_from_formula
+(strip namespaces, drop script/annotation, find the innermost semantics)
+with the former pipeline: objectify.deannotate, the identity XSLT that
+rebuilt the document with local names, deannotate again and one findall
+walk per removed tag. Formulas are a flat mrow of size tokens and a nest of
+size mrows, prefixed with the MathML namespace, with their content
+annotation. Times are per formula, in milliseconds; the nested formulas the
+XSLT cannot process (libxslt depth limit) are reported as failed.
+'''
+import argparse
+import io
+import timeit
+from lxml import etree, objectify
+
+from formula import Formula
+from mathml_presentation_nosnuggle import MathMLPresentation
+
+xslt_raw = '''<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:output method="xml" indent="no"/>
+<xsl:template match="/|comment()|processing-instruction()"><xsl:copy><xsl:apply-templates/></xsl:copy></xsl:template>
+<xsl:template match="*"><xsl:element name="{local-name()}"><xsl:apply-templates select="@*|node()"/></xsl:element></xsl:template>
+<xsl:template match="@*"><xsl:attribute name="{local-name()}"><xsl:value-of select="."/></xsl:attribute></xsl:template>
+</xsl:stylesheet>'''
+transform = etree.XSLT(etree.parse(io.BytesIO(xslt_raw)))
+
+def xslt_normalize(formula):
+    '''
+    the normalization get_doc_from_formula did before the single pass
+    '''
+    objectify.deannotate(formula.doc, cleanup_namespaces=True)
+    doc = transform(formula.doc)
+    objectify.deannotate(doc, cleanup_namespaces=True)
+    for tag in ['script', 'annotation-xml', 'annotation']:
+        for node in doc.findall('.//' + tag):
+            node.getparent().remove(node)
+    semantics = doc
+    if semantics.find('semantics') is None:
+        return None, None
+    while semantics.find('semantics') is not None:
+        semantics = semantics.find('semantics')
+    return (semantics[0], doc) if len(semantics) > 0 else (None, None)
+
+def flat_formula(size):
+    tokens = ''.join('<m:mi>x</m:mi><m:mo>+</m:mo>' if i % 2 else '<m:mn>%d</m:mn><m:mo>-</m:mo>' % i for i in range(size // 2))
+    return wrap('<m:mrow>%s</m:mrow>' % tokens)
+
+def nested_formula(size):
+    return wrap('<m:mrow><m:mi>x</m:mi>' * size + '</m:mrow>' * size)
+
+def wrap(presentation):
+    return ('<m:math xmlns:m="http://www.w3.org/1998/Math/MathML"><m:semantics>%s'
+            '<m:annotation-xml encoding="MathML-Content"><m:ci>x</m:ci></m:annotation-xml>'
+            '<m:annotation encoding="application/x-tex">x</m:annotation></m:semantics></m:math>' % presentation)
+
+def measure(normalize, mathml, repeat):
+    '''
+    return milliseconds per formula (parsing excluded), or None if normalize fails
+    '''
+    formulas = [Formula(mathml) for i in range(repeat)]
+    try:
+        normalize(formulas[0])
+    except etree.XSLTApplyError:
+        return None
+    formulas = iter(formulas[1:])
+    return timeit.timeit(lambda: normalize(next(formulas)), number=repeat - 1) * 1000 / (repeat - 1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the presentation normalization on long formulas.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000, 20000], help='tokens (flat) and depths (nested) of the formulas')
+    parser.add_argument('--repeat', type=int, default=10, help='formulas normalized per measure')
+    args = parser.parse_args()
+    procPres = MathMLPresentation('')
+    print '%-8s %8s %12s %12s %8s' % ('shape', 'size', 'xslt ms', 'single ms', 'speedup')
+    for shape, make in [('flat', flat_formula), ('nested', nested_formula)]:
+        for size in args.sizes:
+            mathml = make(size)
+            single = measure(procPres.get_doc_from_formula, mathml, args.repeat + 1)
+            old = measure(xslt_normalize, mathml, args.repeat + 1)
+            if old is None:
+                print '%-8s %8d %12s %12.3f %8s' % (shape, size, 'failed', single, '-')
+            else:
+                print '%-8s %8d %12.3f %12.3f %7.1fx' % (shape, size, old, single, old / single)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Load the segments written by segments.SegmentWriter (indexer.py --export)
+into Solr through its JSON update handler.
+
+    python indexer.py -j 32 -e paragraph --export export papers.txt
+    python bulkload.py -j 8 --solr http://localhost:9000/solr/mcd.20150203.p export
+
+Segment lines are sent as they are, without decoding the documents: a
+chunk of at most --chunk-docs lines and --chunk-bytes bytes becomes one
+update request, {"add": {...}, "add": {...}, "delete": {...}, ...}, which
+Solr applies in order.
+
+The segments of one writer are loaded one after the other, so a paper's
+delete query always reaches Solr before its new documents; the writers of a
+run are loaded in parallel (-j), and the runs one after the other, oldest
+first. A failed request is retried --retries times. Prints "<segment> ok"
+or "<segment> error" per segment, and commits once at the end.
+'''
+import argparse
+import gzip
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import requests
+
+from segments import list_segments
+
+class LoadError(Exception):
+    pass
+
+class BulkLoader:
+    def __init__(self, url, handler='/update', chunk_docs=10000, chunk_bytes=32 * 1024 * 1024, retries=3, timeout=(5, 600), max_in_flight=4):
+        self.url = url.rstrip('/') + handler
+        self.chunk_docs = chunk_docs
+        self.chunk_bytes = chunk_bytes
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.max_in_flight = max_in_flight
+        self.commands_loaded = 0
+        self.bytes_loaded = 0
+        self.__lock = threading.Lock()
+
+    def post(self, body, params=None):
+        '''
+        send body to the update handler, retrying failed requests
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, data=body, params=params, timeout=self.timeout,
+                                             headers={'Content-Type': 'application/json'})
+                if response.status_code == 200:
+                    return
+                error = 'HTTP %d: %s' % (response.status_code, response.text[:500])
+            except requests.RequestException as e:
+                error = '%s: %s' % (type(e).__name__, e)
+            if attempt < self.retries:
+                time.sleep(2 ** attempt)
+        raise LoadError(error)
+
+    def __send(self, lines):
+        self.post('{' + ','.join(line[1:-1] for line in lines) + '}')
+        with self.__lock:
+            self.commands_loaded += len(lines)
+            self.bytes_loaded += sum(len(line) for line in lines)
+
+    def load_segment(self, segmentpath):
+        lines, size = [], 0
+        with gzip.open(segmentpath, 'rb') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if lines and (len(lines) >= self.chunk_docs or size + len(line) > self.chunk_bytes):
+                    self.__send(lines)
+                    lines, size = [], 0
+                lines.append(line)
+                size += len(line)
+        if lines:
+            self.__send(lines)
+
+    def load_writer(self, segmentpaths):
+        '''
+        load the segments of one writer in order; the segments after a failed one are skipped.
+        return (segment, error or None) for every segment
+        '''
+        results = []
+        for segmentpath in segmentpaths:
+            if results and results[-1][1] is not None:
+                results.append((segmentpath, 'skipped after %s' % results[-1][0]))
+                continue
+            try:
+                self.load_segment(segmentpath)
+                results.append((segmentpath, None))
+            except Exception as e:
+                results.append((segmentpath, '%s: %s' % (type(e).__name__, e)))
+        return results
+
+    def load(self, directory):
+        '''
+        load every segment of directory. yield (segment, error or None) as the writers complete
+        '''
+        runs = []
+        for run, writer, segmentpaths in list_segments(directory):
+            if not runs or runs[-1][0] != run:
+                runs.append((run, []))
+            runs[-1][1].append(segmentpaths)
+        pool = ThreadPool(self.max_in_flight)
+        try:
+            for run, writers in runs:
+                for results in pool.imap_unordered(self.load_writer, writers):
+                    for result in results:
+                        yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def commit(self):
+        self.post('{"commit": {}}')
+
+    def close(self):
+        self.session.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load exported segments into Solr.')
+    parser.add_argument('directory', help='directory of the segments (indexer.py --export)')
+    parser.add_argument('--solr', required=True, help='solr core url')
+    parser.add_argument('--handler', default='/update', help='JSON update handler path (/update/json on Solr 3)')
+    parser.add_argument('-j', '--parallel', type=int, default=4, help='writers loaded at the same time')
+    parser.add_argument('--chunk-docs', type=int, default=10000, help='commands per update request')
+    parser.add_argument('--chunk-bytes', type=int, default=32 * 1024 * 1024, help='bytes per update request')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--no-commit', action='store_true', help='do not commit at the end')
+    args = parser.parse_args()
+    loader = BulkLoader(args.solr, args.handler, args.chunk_docs, args.chunk_bytes, args.retries, max_in_flight=args.parallel)
+    errors = 0
+    start = time.time()
+    try:
+        for segmentpath, error in loader.load(args.directory):
+            if error is None:
+                print segmentpath + ' ok'
+            else:
+                errors += 1
+                print segmentpath + ' error'
+                sys.stderr.write(error + '\n')
+            sys.stdout.flush()
+        if not args.no_commit:
+            loader.commit()
+    finally:
+        loader.close()
+    sys.stderr.write('%d commands, %d bytes in %.1f s\n' % (loader.commands_loaded, loader.bytes_loaded, time.time() - start))
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+import hashlib
+import re
+import sqlite3
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from formula import ENCODER_VERSION
+
+re_tag = re.compile(r'<[^<>]+>')
+re_occurrence_attr = re.compile(r'''\s(?:id|xref)\s*=\s*(?:"[^"]*"|'[^']*')''')
+
+def normalize_mathml(mathml):
+    '''
+    return mathml without the occurrence-specific id and xref attributes
+    '''
+    return re_tag.sub(lambda m: re_occurrence_attr.sub('', m.group(0)), mathml)
+
+def formula_digest(mathml):
+    '''
+    return the sha1 (hex) of the normalized mathml, the same for every occurrence of a formula in the corpus
+    '''
+    if isinstance(mathml, unicode):
+        mathml = mathml.encode('utf-8')
+    return hashlib.sha1(normalize_mathml(mathml)).hexdigest()
+
+class FormulaCache:
+    '''
+    Content-addressed cache of per-formula encodings (the presentation and
+    content paths and hash lists computed by the encoders).
+
+    The key is a digest of the mathml with the occurrence-specific id and
+    xref attributes removed, so repeats of the same formula anywhere in the
+    corpus share an entry. There are two tiers: an in-process LRU of
+    max_entries encodings, and, if path is given, an sqlite file shared by
+    all the workers. Entries are tagged with formula.ENCODER_VERSION and the
+    namespace (the encoder variant, e.g. the MathMLPresentation module);
+    entries of other encoder versions are deleted when the file is opened.
+
+    New entries are written to sqlite every flush_every puts, and on flush
+    or close. Hit and miss counters are in stats().
+    '''
+    def __init__(self, path=None, namespace='', max_entries=100000, flush_every=256):
+        self.namespace = '%s:%s' % (ENCODER_VERSION, namespace)
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.__lru = OrderedDict()
+        self.__pending = []
+        self.__db = None
+        if path:
+            self.__db = sqlite3.connect(path, timeout=60)
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS encodings (key TEXT PRIMARY KEY, version TEXT, value BLOB)')
+            self.__db.execute('DELETE FROM encodings WHERE version != ?', (str(ENCODER_VERSION),))
+            self.__db.commit()
+
+    def normalize(self, mathml):
+        return normalize_mathml(mathml)
+
+    def key(self, mathml):
+        if isinstance(mathml, unicode):
+            mathml = mathml.encode('utf-8')
+        return hashlib.sha1(self.namespace + '\0' + self.normalize(mathml)).hexdigest()
+
+    def __remember(self, key, value):
+        self.__lru[key] = value
+        if len(self.__lru) > self.max_entries:
+            self.__lru.popitem(last=False)
+
+    def get(self, mathml):
+        '''
+        return the cached encoding of mathml, or None
+        '''
+        key = self.key(mathml)
+        value = self.__lru.pop(key, None)
+        if value is not None:
+            self.__lru[key] = value
+            self.hits += 1
+            return value
+        if self.__db is not None:
+            row = self.__db.execute('SELECT value FROM encodings WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = pickle.loads(str(row[0]))
+                self.__remember(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, mathml, value):
+        key = self.key(mathml)
+        self.__remember(key, value)
+        if self.__db is not None:
+            self.__pending.append((key, str(ENCODER_VERSION), sqlite3.Binary(pickle.dumps(value, 2))))
+            if len(self.__pending) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        if self.__db is not None and self.__pending:
+            self.__db.executemany('INSERT OR REPLACE INTO encodings (key, version, value) VALUES (?, ?, ?)', self.__pending)
+            self.__db.commit()
+            self.__pending = []
+
+    def close(self):
+        self.flush()
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'entries': len(self.__lru),
+        }
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Formula dependency graph of a paper (math_adj), with the children of a
+formula resolved to their contexts and descriptions.
+
+    deps = DependencyGraph(adjacency, contexts, descriptions, depth=2)
+    context_children, description_children = deps.children(mid)
+
+adjacency[paraname] is reader.getDepFromLines of the math_adj lines of a
+paragraph (e.g. a reader.ParagraphLRU loading them on demand), contexts and
+descriptions are the per-paragraph dictionaries of the encoders
+(reader.lazyContext, reader.lazyDescription, or those of a sidecar). The
+texts of a formula are looked up once per paper, however many formulas
+depend on it.
+
+With depth 1 the children are those listed in math_adj, in order, as the
+encoders always had them. A larger depth adds the children of the children,
+breadth first, up to depth levels; each formula is then listed once, at its
+shallowest level, and never the formula itself.
+
+sidecar.py --dep-depth N stores the result of children for every formula of
+the corpus, so that the encoders look it up without reading math_adj
+(Sidecar.dependencies).
+'''
+
+class DependencyGraph:
+    def __init__(self, adjacency, contexts, descriptions, depth=1):
+        if depth < 1:
+            raise ValueError('dependency depth has to be at least 1: %d' % depth)
+        self.adjacency = adjacency
+        self.contexts = contexts
+        self.descriptions = descriptions
+        self.depth = depth
+        self.__texts = {} # mid : (context or None, descriptions)
+
+    def direct(self, mid):
+        '''
+        return the children of mid listed in math_adj
+        '''
+        return self.adjacency[mid.split('#', 1)[0]].get(mid, [])
+
+    def texts(self, mid):
+        '''
+        return (context or None, descriptions) of mid
+        '''
+        texts = self.__texts.get(mid)
+        if texts is None:
+            paraname, kmcsid = mid.split('#', 2)[:2]
+            textdictid = tuple([paraname.replace('xhtml', 'txt'), kmcsid])
+            contextDict = self.contexts[textdictid[0]]
+            descDict = self.descriptions[textdictid[0]]
+            texts = self.__texts[mid] = (contextDict[textdictid] if textdictid in contextDict else None,
+                                         descDict[textdictid] if textdictid in descDict else [])
+        return texts
+
+    def descendants(self, mid):
+        '''
+        return the children of mid up to depth levels (see the module documentation)
+        '''
+        if self.depth == 1:
+            return self.direct(mid)
+        seen = set([mid])
+        descendants = []
+        level = [mid]
+        for depth in range(self.depth):
+            next_level = []
+            for parent in level:
+                for child in self.direct(parent):
+                    if child not in seen:
+                        seen.add(child)
+                        next_level.append(child)
+            descendants.extend(next_level)
+            level = next_level
+        return descendants
+
+    def children(self, mid):
+        '''
+        return (context_children, description_children) of mid, lists of strings
+        '''
+        context_children = []
+        description_children = []
+        for child in self.descendants(mid):
+            context, descs = self.texts(child)
+            if context is not None: context_children.append(context)
+            description_children.extend(descs)
+        return context_children, description_children
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+from lxml import etree
+import hashing
+from stagetimer import NULL_TIMER
+from reader import getUnicodeText
+
+# version of the per-formula encoding (paths, sisters and hash lists).
+# bump it whenever an encoder change alters that output: it invalidates
+# cache.FormulaCache entries.
+ENCODER_VERSION = 2
+
+class Formula:
+    '''
+    A mathml cell from math_new, parsed once.
+
+    The presentation and content encoders work on the same in-memory tree:
+    content annotations (annotation-xml) are collected and detached from the
+    tree, and the remaining tree is handed to the presentation encoder, which
+    normalizes it in place. A Formula is therefore consumed by a single
+    presentation pass.
+    '''
+    parser = etree.XMLParser(remove_blank_text=True, encoding='UTF-8', huge_tree=True)
+
+    def __init__(self, string):
+        self.string = string
+        self.doc = etree.fromstring(string, self.parser)
+        self.content = [cmathml for cmathml in self.doc.findall(u'.//annotation-xml') if len(cmathml) > 0]
+        for cmathml in self.doc.findall(u'.//annotation-xml'):
+            cmathml.getparent().remove(cmathml)
+
+def iter_formulas(procPres, mathlns, batch=32, cache=None):
+    '''
+    input: math_new lines (latexmlid, paraname, kmcsid, mathml separated by tabs)
+    yield (line, formula, presentation, encoding) per line, where presentation
+    is what procPres.get_doc_from_formula returns. Presentations are computed
+    batch lines at a time, so that enrichment can run concurrently.
+    encoding is the entry of cache (a cache.FormulaCache) for the mathml, or
+    None. On a cache hit nothing is parsed: formula and presentation are None.
+    '''
+    for start in range(0, len(mathlns), batch):
+        lns = mathlns[start:start + batch]
+        mathmls = ['\t'.join(ln.split('\t')[3:]) for ln in lns]
+        encodings = [cache.get(mathml) for mathml in mathmls] if cache is not None else [None] * len(lns)
+        formulas = [Formula(mathml) if encoding is None else None for mathml, encoding in zip(mathmls, encodings)]
+        parsed = [formula for formula in formulas if formula is not None]
+        presentations = iter(procPres.get_docs_from_formulas(parsed))
+        for ln, formula, encoding in zip(lns, formulas, encodings):
+            presentation = next(presentations) if formula is not None else None
+            yield ln, formula, presentation, encoding
+
+# the per-formula encoding, shared by paragraph_encode and mathmldescription_encode
+def encodePresentation(procPres, presentation_doc, hashes=None, query=False):
+    semantics, presentation = presentation_doc
+    opaths = []
+    upaths = []
+    sisters = []
+    subhash = []
+    sighash = []
+    modhash = []
+    if semantics is not None:
+        opaths, upaths, sisters = procPres.get_paths(semantics, query)
+        upaths = map(lambda paths: ' '.join(map(getUnicodeText, paths)), upaths)
+        sisters = map(lambda family: ' '.join(map(getUnicodeText, family)), sisters)
+        opaths = map(lambda paths: ' '.join(map(getUnicodeText, paths)), opaths) 
+        subhash, sighash, modhash = hashes if hashes is not None else hashing.hash_etree(presentation)
+    return opaths, upaths, sisters, subhash, sighash, modhash
+
+def encodeContent(procCont, formula, hashes=None):
+    oopers = []
+    oargs = []
+    uopers = []
+    uargs = []
+    trees, cmathmls = procCont.encode_formula_as_tree(formula)
+    for tree in trees:
+        ooper, oarg, uoper, uarg = procCont.encode_all_paths(tree)
+        oopers.extend(map(getUnicodeText, ooper))
+        oargs.extend(map(getUnicodeText, oarg))
+        uopers.extend(map(getUnicodeText, uoper))
+        uargs.extend(map(getUnicodeText, uarg))
+    subhash = []
+    sighash = []
+    modhash = []
+    if hashes is None:
+        hashes = map(hashing.hash_etree, cmathmls)
+    for csubhash, csighash, cmodhash in hashes:
+        subhash.extend(csubhash)
+        sighash.extend(csighash)
+        modhash.extend(cmodhash)
+    return oopers, oargs, uopers, uargs, subhash, sighash, modhash
+
+def encodeFormulas(procPres, procCont, formulas, timer=NULL_TIMER):
+    '''
+    input: (formula, presentation_doc) of the formulas to encode, e.g. those of a paragraph
+    return their (encodePresentation, encodeContent) encodings
+    '''
+    trees = []
+    for formula, (semantics, presentation) in formulas:
+        if semantics is not None: trees.append(presentation)
+        trees.extend(formula.content)
+    with timer.stage('hashing'):
+        hashes = iter([hashing.hash_etree(tree) for tree in trees])
+    encodings = []
+    for formula, presentation_doc in formulas:
+        phashes = next(hashes) if presentation_doc[0] is not None else None
+        chashes = [next(hashes) for cmathml in formula.content]
+        with timer.stage('presentation'):
+            presentation_encoding = encodePresentation(procPres, presentation_doc, phashes)
+        with timer.stage('content'):
+            content_encoding = encodeContent(procCont, formula, chashes)
+        encodings.append((presentation_encoding, content_encoding))
+    return encodings
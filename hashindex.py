@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Local inverted index of the hash fields (subtree, sigure and modular
+values of the presentation and of the content), for exact structure lookups
+without Solr.
+
+Build it from the segments exported by the indexer, in the order the bulk
+loader would apply them (a later document with the same id replaces the
+earlier one, and the delete queries of --incremental runs are applied):
+
+    python indexer.py -j 8 -e description --export export papers.txt
+    python hashindex.py build hashes.idx export
+
+and query it in-process, with the query terms of queryserver.QueryEncoder:
+
+    index = HashIndex('hashes.idx')
+    index.query(QueryEncoder('description').encode(mathml), limit=10)
+
+or from the command line (python hashindex.py query hashes.idx MATHML).
+Candidates are ranked by the number of distinct query hash values (field,
+value) they contain.
+
+File layout (little endian): a header (magic, number of fields, number of
+documents, offset of the ids), one directory entry per field (name, number
+of slots, offset of its table), and per field the posting lists followed by
+an open-addressing table of (hash value, posting list offset, documents,
+bytes) slots, at most half full and probed linearly. A posting list is the
+sorted document numbers, delta-encoded as varints. The ids are an array of
+offsets followed by the utf-8 ids.
+'''
+import argparse
+import gzip
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+
+MAGIC = 'MCHIDX01'
+HEADER = struct.Struct('<8sIQQ')
+FIELD = struct.Struct('<32sQQ')
+SLOT = struct.Struct('<qQII')
+OFFSET = struct.Struct('<Q')
+HASH_FIELDS = ['subtree_presentation', 'sigure_presentation', 'modular_presentation',
+               'subtree_content', 'sigure_content', 'modular_content']
+
+re_paper_query = re.compile(r'^gpid:(.*?)\\?/\*$') # the / before * was not escaped in older exports
+re_lucene_escape = re.compile(r'\\(.)')
+
+def hash_value(value):
+    '''
+    input: a hash value as in the documents: an int, its string, or term|frequency (paragraph_encode compact mode)
+    '''
+    if isinstance(value, basestring):
+        return int(value.split('|', 1)[0])
+    return int(value)
+
+def query_paper(query):
+    '''
+    return the paper path of a manifest.paper_query delete query (gpid:1\\/0704.0001\\/*)
+    '''
+    m = re_paper_query.match(query)
+    if m is None:
+        raise ValueError('unsupported delete query: %s' % query)
+    return re_lucene_escape.sub(r'\1', m.group(1))
+
+def encode_postings(docnums):
+    '''
+    sorted document numbers -> varints of the gaps
+    '''
+    encoded = bytearray()
+    last = 0
+    for docnum in docnums:
+        gap = docnum - last
+        last = docnum
+        while gap >= 0x80:
+            encoded.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        encoded.append(gap)
+    return encoded
+
+def decode_postings(encoded):
+    docnums = []
+    last = value = shift = 0
+    for byte in bytearray(encoded):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            last += value
+            docnums.append(last)
+            value = shift = 0
+    return docnums
+
+class HashIndexWriter:
+    '''
+    Build a hash index: add the encoder documents, then close(). Same
+    interface as uploader.BatchUploader, so it can also be passed to
+    encode_file directly.
+
+    Documents without id_field are skipped. The posting lists are kept in
+    memory (4 bytes per distinct value of a document) until close.
+    '''
+    def __init__(self, indexpath, id_field='gmid', fields=HASH_FIELDS):
+        self.path = indexpath
+        self.id_field = id_field
+        self.fields = list(fields)
+        self.docs_added = 0
+        self.ndocs = 0
+        self.closed = False
+        self.__postings = dict((field, {}) for field in self.fields)
+        self.__ids = []
+        self.__docnums = {} # id : document number
+        self.__papers = {} # paper path : document numbers
+        self.__deleted = set()
+
+    def add(self, doc):
+        docid = doc.get(self.id_field)
+        if isinstance(docid, list):
+            docid = docid[0] if docid else None
+        if docid is None:
+            return
+        if isinstance(docid, str):
+            docid = docid.decode('utf-8')
+        docnum = len(self.__ids)
+        if docid in self.__docnums:
+            self.__deleted.add(self.__docnums[docid])
+        self.__docnums[docid] = docnum
+        self.__ids.append(docid)
+        gpid = doc.get('gpid')
+        if gpid:
+            self.__papers.setdefault(gpid.rsplit('/', 1)[0], []).append(docnum)
+        for field in self.fields:
+            postings = self.__postings[field]
+            for h in set(hash_value(value) for value in doc.get(field, [])):
+                docnums = postings.get(h)
+                if docnums is None:
+                    docnums = postings[h] = array('I')
+                docnums.append(docnum)
+        self.docs_added += 1
+
+    def add_many(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    def delete_query(self, query):
+        '''
+        delete the documents of a paper, for the queries of manifest.paper_query only
+        '''
+        self.__deleted.update(self.__papers.pop(query_paper(query), []))
+
+    def flush(self):
+        pass
+
+    def __write_field(self, f, postings, renumber):
+        '''
+        write the posting lists and the table of a field at the end of f. return (number of slots, table offset)
+        '''
+        slots = []
+        for h, docnums in postings.iteritems():
+            docnums = [renumber[docnum] for docnum in docnums if renumber[docnum] >= 0]
+            if not docnums:
+                continue
+            encoded = encode_postings(docnums)
+            slots.append((h, f.tell(), len(docnums), len(encoded)))
+            f.write(encoded)
+        nslots = 1
+        while nslots < 2 * len(slots):
+            nslots *= 2
+        table = [None] * nslots
+        for slot in slots:
+            i = slot[0] % nslots
+            while table[i] is not None:
+                i = (i + 1) % nslots
+            table[i] = slot
+        table_offset = f.tell()
+        empty = SLOT.pack(0, 0, 0, 0)
+        for slot in table:
+            f.write(SLOT.pack(*slot) if slot is not None else empty)
+        return nslots, table_offset
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        renumber = array('l', [-1]) * len(self.__ids)
+        ids = []
+        for docnum, docid in enumerate(self.__ids):
+            if docnum not in self.__deleted:
+                renumber[docnum] = len(ids)
+                ids.append(docid.encode('utf-8'))
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write('\0' * (HEADER.size + FIELD.size * len(self.fields)))
+            directory = []
+            for field in self.fields:
+                directory.append((field,) + self.__write_field(f, self.__postings.pop(field), renumber))
+            ids_offset = f.tell()
+            offset = ids_offset + OFFSET.size * (len(ids) + 1)
+            for docid in ids:
+                f.write(OFFSET.pack(offset))
+                offset += len(docid)
+            f.write(OFFSET.pack(offset))
+            for docid in ids:
+                f.write(docid)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, len(self.fields), len(ids), ids_offset))
+            for entry in directory:
+                f.write(FIELD.pack(*entry))
+        os.rename(tmppath, self.path)
+        self.ndocs = len(ids)
+
+class HashIndex:
+    '''
+    Read-only view of a hash index, memory-mapped so that processes share it
+    through the page cache.
+    '''
+    def __init__(self, indexpath):
+        with open(indexpath, 'rb') as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nfields, self.ndocs, self.ids_offset = HEADER.unpack_from(self.__map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a hash index' % indexpath)
+        self.fields = {}
+        for i in range(nfields):
+            name, nslots, table_offset = FIELD.unpack_from(self.__map, HEADER.size + i * FIELD.size)
+            self.fields[name.rstrip('\0')] = (nslots, table_offset)
+
+    def __slot(self, field, h):
+        '''
+        return (posting list offset, documents, bytes) of h in field, or None
+        '''
+        if field not in self.fields:
+            return None
+        nslots, table_offset = self.fields[field]
+        if nslots == 0:
+            return None
+        i = h % nslots
+        while True:
+            slot_hash, offset, ndocs, nbytes = SLOT.unpack_from(self.__map, table_offset + i * SLOT.size)
+            if nbytes == 0:
+                return None
+            if slot_hash == h:
+                return offset, ndocs, nbytes
+            i = (i + 1) % nslots
+
+    def document_frequency(self, field, value):
+        slot = self.__slot(field, hash_value(value))
+        return slot[1] if slot is not None else 0
+
+    def postings(self, field, value):
+        '''
+        return the document numbers whose field contains the hash value
+        '''
+        slot = self.__slot(field, hash_value(value))
+        if slot is None:
+            return []
+        offset, ndocs, nbytes = slot
+        return decode_postings(self.__map[offset:offset + nbytes])
+
+    def doc_id(self, docnum):
+        start, end = struct.unpack_from('<QQ', self.__map, self.ids_offset + docnum * OFFSET.size)
+        return self.__map[start:end].decode('utf-8')
+
+    def query(self, terms, limit=10, max_postings=None):
+        '''
+        terms: {field: hash values}, e.g. the output of queryserver.QueryEncoder.encode; the
+        fields that are not indexed are ignored. values found in more than max_postings documents are skipped.
+        return [(id, number of distinct (field, value) matched)], best first, at most limit
+        '''
+        counts = {}
+        for field, values in terms.iteritems():
+            if field not in self.fields:
+                continue
+            for h in set(hash_value(value) for value in values):
+                slot = self.__slot(field, h)
+                if slot is None or (max_postings is not None and slot[1] > max_postings):
+                    continue
+                offset, ndocs, nbytes = slot
+                for docnum in decode_postings(self.__map[offset:offset + nbytes]):
+                    counts[docnum] = counts.get(docnum, 0) + 1
+        best = heapq.nsmallest(limit, counts.iteritems(), key=lambda item: (-item[1], item[0]))
+        return [(self.doc_id(docnum), count) for docnum, count in best]
+
+    def close(self):
+        self.__map.close()
+
+def read_segments(directory):
+    '''
+    yield the commands of the segments exported to directory, in the order bulkload.py applies them
+    '''
+    from segments import list_segments
+    for run, writer, segmentpaths in list_segments(directory):
+        for segmentpath in segmentpaths:
+            with gzip.open(segmentpath, 'rb') as f:
+                for line in f:
+                    yield json.loads(line)
+
+def build(indexpath, directory, id_field='gmid'):
+    writer = HashIndexWriter(indexpath, id_field)
+    for command in read_segments(directory):
+        if 'add' in command:
+            writer.add(command['add']['doc'])
+        elif 'delete' in command:
+            writer.delete_query(command['delete']['query'])
+    writer.close()
+    return writer.ndocs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query a local index of the hash fields.')
+    commands = parser.add_subparsers(dest='command')
+    build_parser = commands.add_parser('build', help='index the documents of exported segments (indexer.py --export)')
+    build_parser.add_argument('index', help='file to write')
+    build_parser.add_argument('segments', help='directory of the segments')
+    build_parser.add_argument('--id-field', default='gmid', help='document field returned by queries (gpid for the paragraph encoder)')
+    query_parser = commands.add_parser('query', help='print the best candidates of a query mathml')
+    query_parser.add_argument('index')
+    query_parser.add_argument('mathml', help='query mathml, - for stdin')
+    query_parser.add_argument('-e', '--encoder', default='description', help='encoder the index was built with')
+    query_parser.add_argument('-n', '--limit', type=int, default=10)
+    query_parser.add_argument('--max-postings', type=int, help='skip the hash values of more documents than this')
+    args = parser.parse_args()
+    if args.command == 'build':
+        start = time.time()
+        docs = build(args.index, args.segments, args.id_field)
+        sys.stderr.write('%d documents indexed in %.1f s\n' % (docs, time.time() - start))
+    else:
+        from queryserver import QueryEncoder
+        mathml = sys.stdin.read() if args.mathml == '-' else args.mathml
+        terms = QueryEncoder(args.encoder).encode(mathml)
+        index = HashIndex(args.index)
+        start = time.time()
+        results = index.query(terms, args.limit, args.max_postings)
+        elapsed = time.time() - start
+        for docid, count in results:
+            print '%s\t%d' % (docid.encode('utf-8'), count)
+        sys.stderr.write('%d documents, query in %.0f us\n' % (index.ndocs, elapsed * 1e6))
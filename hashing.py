@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+# single pass hashing for mathml.
+# walks the tree once and returns the subtree, sigure and modular hash value
+# sets, identical to subtree.hash_mml, sigure.hash_mml and modular.hash_mml.
+# hash_etree does the same on an lxml tree without serializing it for minidom.
+# the walks are iterative (an explicit stack of HashFrame), so deep formulas
+# do not hit the recursion limit.
+
+import re
+from xml.dom import minidom
+from ctypes import c_longlong
+from lxml import etree
+from mathml import cut_nomeaning_text
+from sigure import HashResult, to_longlong
+from symhash import symbol_hash
+
+MODULAR_DUP_PARAM = 2 ** 32
+re_blank = re.compile(r'\A\s*\Z')
+
+class HashSets:
+    def __init__(self):
+        self.subtree = []
+        self.sigure = []
+        self.modular = []
+
+def hash_leaf(mml_elem):
+    # mml_elem : minidom mml element that has no children.
+    # returns : hash value shared by the subtree, sigure and modular leaves.
+    if mml_elem.nodeType == mml_elem.TEXT_NODE:
+        return symbol_hash(mml_elem.data)
+    return symbol_hash(mml_elem.localName)
+
+def sigure_mi(mml_elem):
+    # mml_elem : minidom mml element that tag name is mi or ci.
+    # returns : sigure variable named by the first text child.
+    if len(mml_elem.childNodes) == 0 or mml_elem.firstChild.nodeType != mml_elem.TEXT_NODE:
+        return HashResult(var_name = "")
+    return HashResult(var_name = mml_elem.firstChild.data)
+
+def subtree_node(seed, args):
+    # seed : hash value of the tag name (or of the operator for apply).
+    # args : subtree hash values from children nodes.
+    var = c_longlong(seed)
+    a = seed | 1
+    for arg in args:
+        var = c_longlong(var.value * a + arg)
+    return var.value
+
+def modular_node(seed, args, dup_param):
+    # seed : hash value of the tag name (or of the operator for apply).
+    # args : modular hash values from children nodes.
+    var = c_longlong(0)
+    a = seed | 1
+    for arg in args:
+        var = c_longlong(var.value * a + arg)
+    var = c_longlong(var.value * dup_param + seed)
+    return var.value
+
+def sigure_apply(args):
+    # args : sigure HashResult from children nodes, operator first.
+    op_var = args[0].value()
+    result = args[0]
+    result.rebase(op_var)
+    for arg in args[1:]:
+        result.merge(op_var, arg)
+    return result
+
+def sigure_node(name, args):
+    # name : tag name of the internal node.
+    # args : sigure HashResult from children nodes.
+    a, b = to_longlong(symbol_hash(name[0::2])), to_longlong(symbol_hash(name[1::2]))
+    result = HashResult(value = b)
+    for arg in args:
+        result.merge(a, arg)
+    return result
+
+class HashFrame(object):
+    # an internal node being hashed: its children iterator and the values of the children done so far.
+    __slots__ = ('name', 'children', 'with_sigure', 'is_var', 'sig', 'sub_args', 'sig_args', 'mod_args')
+
+    def __init__(self, name, children, with_sigure, is_var, sig):
+        self.name = name
+        self.children = children
+        self.with_sigure = with_sigure
+        self.is_var = is_var
+        self.sig = sig
+        self.sub_args = []
+        self.sig_args = []
+        self.mod_args = []
+
+    def add(self, values):
+        sub, sig, mod = values
+        self.sub_args.append(sub)
+        self.sig_args.append(sig)
+        self.mod_args.append(mod)
+
+def hash_frame(frame, sets, dup_param):
+    # frame : HashFrame whose children are all hashed.
+    # returns : subtree value, sigure HashResult (or None) and modular value of the node.
+    name, sub_args, mod_args = frame.name, frame.sub_args, frame.mod_args
+    sets.subtree.extend(sub_args)
+    sets.modular.extend(mod_args)
+
+    if name == "apply":
+        sub_var = subtree_node(sub_args[0], sub_args[1:])
+        mod_var = modular_node(mod_args[0], mod_args[1:], dup_param)
+    else:
+        seed = symbol_hash(name)
+        sub_var = subtree_node(seed, sub_args)
+        mod_var = modular_node(seed, mod_args, dup_param)
+
+    sig = frame.sig
+    if frame.with_sigure and not frame.is_var:
+        if name == "apply": sig = sigure_apply(frame.sig_args)
+        else: sig = sigure_node(name, frame.sig_args)
+        sets.sigure.append(sig.value())
+    return sub_var, sig, mod_var
+
+def hash_walk(root, enter, sets, dup_param, with_sigure=True):
+    # root : node to hash.
+    # enter : function(node, sets, with_sigure) returning the values of a node
+    #         without children, or a HashFrame to descend into.
+    # returns : subtree value, sigure HashResult (or None) and modular value of root.
+    values = enter(root, sets, with_sigure)
+    if not isinstance(values, HashFrame):
+        return values
+    stack = [values]
+    while stack:
+        frame = stack[-1]
+        child = next(frame.children, None)
+        if child is None:
+            stack.pop()
+            values = hash_frame(frame, sets, dup_param)
+            if stack: stack[-1].add(values)
+            continue
+        values = enter(child, sets, frame.with_sigure and not frame.is_var)
+        if isinstance(values, HashFrame): stack.append(values)
+        else: frame.add(values)
+    return values
+
+def hash_enter(mml_elem, sets, with_sigure):
+    # mml_elem : minidom mml element object.
+    # sets : HashSets accumulating the values of the subtree rooted at mml_elem.
+    # with_sigure : False below mi/ci, where sigure does not descend.
+    # returns : subtree value, sigure HashResult (or None) and modular value of a node without children, or a HashFrame.
+    name = mml_elem.localName
+    if name == "qvar":
+        var = symbol_hash(mml_elem.getAttribute('name'))
+        sig = None
+        if with_sigure:
+            sig = HashResult(var_name = mml_elem.getAttribute('name'))
+            sets.sigure.append(sig.value())
+        return var, sig, var
+
+    is_var = with_sigure and name in ["mi", "ci"]
+    sig = None
+    if is_var:
+        sig = sigure_mi(mml_elem)
+        sets.sigure.append(sig.value())
+
+    if not mml_elem.hasChildNodes():
+        var = hash_leaf(mml_elem)
+        if with_sigure and not is_var:
+            sig = HashResult(value = var)
+            sets.sigure.append(var)
+        return var, sig, var
+    return HashFrame(name, iter(mml_elem.childNodes), with_sigure, is_var, sig)
+
+def hash_recursion(mml_elem, sets, dup_param, with_sigure=True):
+    # mml_elem : minidom mml element object.
+    # sets : HashSets accumulating the values of the subtree rooted at mml_elem.
+    # returns : subtree value, sigure HashResult (or None) and modular value of mml_elem.
+    return hash_walk(mml_elem, hash_enter, sets, dup_param, with_sigure)
+
+def etree_name(elem):
+    # elem : lxml node.
+    # returns : minidom localName of the node (None for comments and processing instructions).
+    if not isinstance(elem.tag, basestring):
+        return None
+    return etree.QName(elem).localname
+
+def etree_children(elem):
+    # elem : lxml element.
+    # returns : child nodes as minidom sees them after cut_nomeaning_text, text nodes as strings.
+    if not isinstance(elem.tag, basestring):
+        return []
+    children = []
+    if elem.text and not re_blank.match(elem.text):
+        children.append(elem.text)
+    for child in elem:
+        children.append(child)
+        if child.tail and not re_blank.match(child.tail):
+            children.append(child.tail)
+    return children
+
+def hash_etree_enter(elem, sets, with_sigure):
+    # elem : lxml element, or a string for a text node.
+    # same as hash_enter for minidom.
+    if isinstance(elem, basestring):
+        var = symbol_hash(elem)
+        sig = None
+        if with_sigure:
+            sig = HashResult(value = var)
+            sets.sigure.append(var)
+        return var, sig, var
+
+    name = etree_name(elem)
+    if name == "qvar":
+        var = symbol_hash(elem.get('name', ''))
+        sig = None
+        if with_sigure:
+            sig = HashResult(var_name = elem.get('name', ''))
+            sets.sigure.append(sig.value())
+        return var, sig, var
+
+    children = etree_children(elem)
+    is_var = with_sigure and name in ["mi", "ci"]
+    sig = None
+    if is_var:
+        if len(children) == 0 or not isinstance(children[0], basestring):
+            sig = HashResult(var_name = "")
+        else:
+            sig = HashResult(var_name = children[0])
+        sets.sigure.append(sig.value())
+
+    if not children:
+        var = symbol_hash(name)
+        if with_sigure and not is_var:
+            sig = HashResult(value = var)
+            sets.sigure.append(var)
+        return var, sig, var
+    return HashFrame(name, iter(children), with_sigure, is_var, sig)
+
+def hash_etree_recursion(elem, sets, dup_param, with_sigure=True):
+    # elem : lxml element, or a string for a text node.
+    # same as hash_recursion for minidom.
+    return hash_walk(elem, hash_etree_enter, sets, dup_param, with_sigure)
+
+def hash_mml(mml, dup_param = MODULAR_DUP_PARAM):
+    # mml : minidom mml object (top is m:math or math).
+    # returns : subtree, sigure and modular hashed value sets.
+    cut_nomeaning_text(mml)
+    if mml.nodeType == mml.DOCUMENT_NODE:
+        mml_top = mml.documentElement
+    else:
+        mml_top = mml
+    sets = HashSets()
+    sub_var, sig, mod_var = hash_recursion(mml_top, sets, dup_param)
+    sets.subtree.append(sub_var)
+    sets.modular.append(mod_var)
+    return sets.subtree, sets.sigure, sets.modular
+
+def hash_etree(elem, dup_param = MODULAR_DUP_PARAM):
+    # elem : lxml element or element tree (top is math, or annotation-xml).
+    # returns : subtree, sigure and modular hashed value sets.
+    if isinstance(elem, etree._ElementTree):
+        elem = elem.getroot()
+    sets = HashSets()
+    sub_var, sig, mod_var = hash_etree_recursion(elem, sets, dup_param)
+    sets.subtree.append(sub_var)
+    sets.modular.append(mod_var)
+    return sets.subtree, sets.sigure, sets.modular
+
+def hash_string(string, dup_param = MODULAR_DUP_PARAM):
+    mml = minidom.parseString(string)
+    return hash_mml(mml, dup_param)
+
+def hash_file(path, dup_param = MODULAR_DUP_PARAM):
+    # path : path to mml file.
+    # returns : subtree, sigure and modular hashed value sets.
+    mml = minidom.parse(path)
+    return hash_mml(mml, dup_param)
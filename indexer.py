@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Index a list of papers with a pool of long-lived worker processes.
+
+    python indexer.py -j 8 -e paragraph papers.txt
+    find 1/ -name '*.txt' | python indexer.py -j 8 -e description -
+
+Replaces `forklift.rb run N "python paragraph_encode.py {}"`: every worker
+imports the encoder once, and keeps its MathMLPresentation (with the compiled
+XSLT), MathMLContent and SolrConnection for all the papers it handles.
+Prints "<paper> ok" or "<paper> error" per paper, like the encoder scripts.
+
+Documents go through an uploader.BatchUploader per worker, so they are
+batched across the paragraphs of a paper, and the uploader is flushed before
+the paper is reported: "<paper> ok" means its documents were accepted by
+Solr. A failure of the final commit (or of any upload when the worker
+closes) is written to stderr and counted in the exit status.
+
+With --incremental MANIFEST only the papers whose inputs or encoder version
+changed since the last run are indexed (see manifest.Manifest); their old
+documents are deleted first. The documents of manifest papers whose math_new
+file is gone are deleted; with --prune, those of every manifest paper missing
+from the list are (only use it with the full list of papers). A paper is recorded in the manifest once its documents
+are uploaded, so failed papers are retried by the next run.
+
+    python indexer.py -j 8 -e paragraph --incremental paragraph.manifest papers.txt
+
+With --sidecar FILE (built by sidecar.py) the contexts and descriptions are
+looked up in the sidecar instead of the text directories; rebuild it when
+those change. Papers missing from it are read from the directories.
+
+With --stats-json FILE and/or --stats-prom FILE the workers time the stages
+of encode_file (see stagetimer) and count the formulas, cache hits, paths,
+hash values, documents and bytes handed to the uploader of every paper.
+--stats-json appends one JSON record per paper; --stats-prom writes the
+totals of the run in the Prometheus text format, rewritten every
+--stats-every papers and at the end. Without them, timing is off.
+
+    python indexer.py -j 8 -e paragraph --stats-json stats.jsonl --stats-prom mcat.prom papers.txt
+
+With --export DIR the documents (and the delete queries of --incremental)
+are written to compressed segment files in DIR instead of being uploaded
+(see segments.SegmentWriter), one writer per worker, so encoding does not
+wait on Solr; load them afterwards with bulkload.py.
+
+    python indexer.py -j 32 -e paragraph --export export papers.txt
+
+With --compact (paragraph encoder only) the path and hash fields carry each
+distinct term of a paragraph once, as term|frequency, for a payload field
+type (see paragraph_encode.compactTerms).
+
+With --minhash 64x16 the documents also get MinHash signatures of their
+subtree values and the LSH band keys of the signatures (minhash_* and lsh_*
+fields, see minhash.MinHasher), for near-duplicate search.
+
+With --dedup (description encoder only) the mathml, paths and hash values
+of a formula are stored once, in a formula document with the gmid
+formula#<digest>, and the occurrence documents only carry their ids, text
+fields and formula_id (see mathmldescription_encode.encodeParagraph; join
+them at query time with joinQuery and expandDocs). Every worker remembers
+the formula documents solr has, up to --dedup-memory formulas; those of a
+paper are only remembered once the paper is flushed, so the formula
+documents of a failed paper are sent again. The formula documents are not
+deleted with the papers in incremental runs.
+
+With --dep-depth N the context_children and description_children of a
+formula are gathered from its descendants in math_adj up to N levels, not
+only its children (see depgraph).
+'''
+import argparse
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+import time
+import traceback
+from os import path
+
+import solr
+from uploader import BatchUploader
+from segments import SegmentWriter
+from cache import FormulaCache
+from sidecar import Sidecar
+from formula import ENCODER_VERSION
+from manifest import Manifest, paper_query
+from stagetimer import StageTimer, StageTotals
+
+encoders = {
+    'paragraph': 'paragraph_encode',
+    'description': 'mathmldescription_encode',
+}
+DEDUP_MEMORY = 1000000
+
+worker = {}
+
+def close_worker():
+    if worker['cache'] is not None:
+        worker['cache'].close()
+        stats = worker['cache'].stats()
+        sys.stderr.write('cache: %(hits)d hits (%(disk_hits)d from disk), %(misses)d misses\n' % stats)
+    try:
+        worker['solr'].close()
+    except Exception:
+        #reported by run, after the pool is joined
+        worker['close_errors'].put('worker %d: %s' % (worker['pid'], traceback.format_exc()))
+
+def open_sink(module, solr_url=None, uploader_args={}, export=None):
+    '''
+    export: (directory, run) to write the documents to segments, None to upload them to solr
+    '''
+    if export is not None:
+        directory, run = export
+        return SegmentWriter(directory, run, str(os.getpid()))
+    return BatchUploader(solr.SolrConnection(solr_url or module.solrUrl), **uploader_args)
+
+def init_worker(encoder, solr_url, uploader_args, cache_path, sidecar_path, timing=False, export=None, encode_args={}, dedup_memory=DEDUP_MEMORY, close_errors=None):
+    module = __import__(encoders[encoder])
+    worker['module'] = module
+    worker['procPres'] = module.MathMLPresentation(module.snuggleUrl)
+    worker['procCont'] = module.MathMLContent()
+    worker['solr'] = open_sink(module, solr_url, uploader_args, export)
+    worker['export'] = export
+    worker['close_errors'] = close_errors
+    worker['cache'] = FormulaCache(cache_path, module.MathMLPresentation.__module__) if cache_path else None
+    worker['sidecar'] = Sidecar(sidecar_path) if sidecar_path else None
+    worker['timing'] = timing
+    worker['encode_args'] = encode_args
+    worker['emitted'] = set() # digests of the formula documents solr has, in dedup mode
+    worker['dedup_memory'] = dedup_memory
+    worker['pid'] = multiprocessing.current_process().pid
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+def index_paper(task):
+    '''
+    return filepath, the traceback if it failed, and the stage timer record if timing
+    '''
+    filepath, replace = task
+    timer = StageTimer() if worker['timing'] else None
+    start, bytes_added = time.time(), worker['solr'].bytes_added
+    error = None
+    encode_args = worker['encode_args']
+    added = set() # digests of the formula documents sent for this paper, in dedup mode
+    if encode_args.get('dedup'):
+        if len(worker['emitted']) > worker['dedup_memory']:
+            worker['emitted'].clear()
+        encode_args = dict(encode_args, emitted=worker['emitted'], added=added)
+    try:
+        if replace:
+            worker['solr'].delete_query(paper_query(filepath))
+        worker['module'].encode_file(filepath, worker['solr'], worker['procPres'], worker['procCont'], worker['cache'], worker['sidecar'], timer, **encode_args)
+        #uploads: the paper is only ok once solr has its documents. segments: complete them per paper when incremental
+        if replace or worker['export'] is None:
+            worker['solr'].flush()
+        worker['emitted'].update(added)
+    except Exception:
+        error = traceback.format_exc()
+    if timer is None:
+        return filepath, error, None
+    timer.add('total', time.time() - start)
+    timer.count('upload_bytes', worker['solr'].bytes_added - bytes_added)
+    return filepath, error, timer.record(paper=filepath, status='ok' if error is None else 'error', pid=worker['pid'])
+
+def read_papers(listfile):
+    lns = sys.stdin if listfile == '-' else open(listfile)
+    for ln in lns:
+        if ln.strip():
+            yield path.relpath(ln.strip(), '.')
+
+def plan_incremental(papers, encoder, manifest, solr_url=None, export=None, prune=False):
+    '''
+    delete the documents of the papers that are in manifest but not in papers, and whose
+    math_new file is gone (any of them if prune).
+    return the changed papers, and their manifest records
+    '''
+    module = __import__(encoders[encoder])
+    papers = list(papers)
+    records = {}
+    for filepath in papers:
+        changed, record = manifest.check(module, filepath)
+        if changed:
+            records[filepath] = record
+    manifest.commit()
+    removed = sorted(filepath for filepath in manifest.papers() - set(papers)
+                     if prune or not path.exists(path.join(module.mathDir, filepath)))
+    if removed:
+        uploader = open_sink(module, solr_url, export=export)
+        for filepath in removed:
+            uploader.delete_query(paper_query(filepath))
+        uploader.close()
+        for filepath in removed:
+            manifest.remove(filepath)
+            print filepath + ' deleted'
+        manifest.commit()
+    return [filepath for filepath in papers if filepath in records], records
+
+def run(papers, encoder, processes, solr_url=None, uploader_args={}, cache_path=None, manifest_path=None, sidecar_path=None, verbose=False,
+        stats_json=None, stats_prom=None, stats_every=100, export_dir=None, encode_args={}, dedup_memory=DEDUP_MEMORY, prune=False):
+    export = (export_dir, '%s-%s' % (encoder, time.strftime('%Y%m%dT%H%M%S'))) if export_dir else None
+    manifest = None
+    if manifest_path:
+        options = sorted(key if value is True else '%s=%s' % (key, value) for key, value in encode_args.iteritems())
+        manifest = Manifest(manifest_path, ':'.join([encoder, str(ENCODER_VERSION)] + options))
+        papers, records = plan_incremental(papers, encoder, manifest, solr_url, export, prune)
+    timing = bool(stats_json or stats_prom)
+    statsfile = open(stats_json, 'a') if stats_json else None
+    totals = StageTotals(encoder)
+    close_errors = multiprocessing.Queue()
+    pool = multiprocessing.Pool(processes, init_worker, (encoder, solr_url, uploader_args, cache_path, sidecar_path, timing, export, encode_args, dedup_memory, close_errors))
+    errors = 0
+    try:
+        tasks = ((filepath, manifest is not None) for filepath in papers)
+        for filepath, error, record in pool.imap_unordered(index_paper, tasks):
+            if record is not None:
+                totals.add(record, record['status'])
+                if statsfile is not None:
+                    statsfile.write(json.dumps(record, sort_keys=True) + '\n')
+                if stats_prom and sum(totals.papers.values()) % stats_every == 0:
+                    totals.write(stats_prom)
+            if error is None:
+                if manifest is not None:
+                    manifest.update(filepath, records[filepath])
+                    manifest.commit()
+                print filepath + ' ok'
+            else:
+                errors += 1
+                print filepath + ' error'
+                if verbose: sys.stderr.write(error)
+            sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        while not close_errors.empty():
+            errors += 1
+            sys.stderr.write(close_errors.get())
+        if manifest is not None:
+            manifest.close()
+        if statsfile is not None:
+            statsfile.close()
+        if stats_prom:
+            totals.write(stats_prom)
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index papers with persistent encoder workers.')
+    parser.add_argument('papers', help='file listing the papers (e.g. 1/0704.0097.txt), one per line; - for stdin')
+    parser.add_argument('-e', '--encoder', choices=sorted(encoders), default='paragraph')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--solr', help='solr core url, defaults to the encoder solrUrl')
+    parser.add_argument('--batch-docs', type=int, default=500, help='documents per solr request')
+    parser.add_argument('--batch-bytes', type=int, default=8 * 1024 * 1024, help='approximate bytes per solr request')
+    parser.add_argument('--commit-every', type=int, default=0, help='commit after this many documents per worker (0: only at the end)')
+    parser.add_argument('--cache', help='sqlite file caching per-formula encodings, shared by the workers')
+    parser.add_argument('--incremental', metavar='MANIFEST', help='sqlite manifest of the indexed papers; only index the papers that changed since the last run')
+    parser.add_argument('--prune', action='store_true', help='with --incremental, delete every indexed paper missing from the list, not only those whose math_new file is gone')
+    parser.add_argument('--sidecar', help='context/description index built by sidecar.py, used instead of the text directories')
+    parser.add_argument('--export', metavar='DIR', help='write the documents to compressed segment files in DIR instead of uploading them (load them with bulkload.py)')
+    parser.add_argument('--compact', action='store_true', help='send each distinct path and hash term of a paragraph once, with its frequency (paragraph encoder)')
+    parser.add_argument('--minhash', metavar='PERMxBANDS', help='add MinHash signatures of this size and their LSH band keys, e.g. 64x16')
+    parser.add_argument('--dedup', action='store_true', help='store the fields of each distinct formula once, in a formula document referenced by its occurrences (description encoder)')
+    parser.add_argument('--dedup-memory', type=int, default=DEDUP_MEMORY, help='formula documents a worker remembers having sent, in dedup mode')
+    parser.add_argument('--dep-depth', type=int, default=1, help='levels of math_adj dependencies gathered in context_children and description_children')
+    parser.add_argument('--stats-json', metavar='FILE', help='append per-paper stage timings and counts to FILE, one JSON record per line')
+    parser.add_argument('--stats-prom', metavar='FILE', help='write the run totals of the stage timings and counts to FILE, in the Prometheus text format')
+    parser.add_argument('--stats-every', type=int, default=100, help='papers between two rewrites of the --stats-prom file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print tracebacks of failed papers to stderr')
+    args = parser.parse_args()
+    if args.prune and not args.incremental:
+        parser.error('--prune applies to --incremental runs only')
+    if args.compact and args.encoder != 'paragraph':
+        parser.error('--compact applies to the paragraph encoder only')
+    if args.dedup and args.encoder != 'description':
+        parser.error('--dedup applies to the description encoder only')
+    encode_args = dict(compact=True) if args.compact else {}
+    if args.dedup:
+        encode_args['dedup'] = True
+    if args.dep_depth < 1:
+        parser.error('--dep-depth has to be at least 1')
+    if args.dep_depth != 1:
+        encode_args['dep_depth'] = args.dep_depth
+    if args.minhash:
+        from minhash import MinHasher
+        try:
+            encode_args['minhash'] = MinHasher.parse(args.minhash)
+        except ValueError as e:
+            parser.error(str(e))
+    uploader_args = dict(max_docs=args.batch_docs, max_bytes=args.batch_bytes, commit_every=args.commit_every)
+    errors = run(read_papers(args.papers), args.encoder, args.processes, args.solr, uploader_args, args.cache, args.incremental, args.sidecar, args.verbose,
+                 args.stats_json, args.stats_prom, args.stats_every, args.export, encode_args, args.dedup_memory, args.prune)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+import hashlib
+import re
+import sqlite3
+from os import listdir, path, stat
+
+re_lucene_special = re.compile(r'([+\-!(){}\[\]^"~*?:\\/&|\s])')
+
+def paper_inputs(module, filepath):
+    '''
+    input: encoder module (paragraph_encode or mathmldescription_encode) and 1/0704.0097.txt
+    return the (name, path) of every input encode_file reads for the paper
+    '''
+    paperpath = filepath[:filepath.rindex('.')]
+    return [('math_new', path.join(module.mathDir, filepath)),
+            ('math_adj', path.join(module.mathadjDir, filepath)),
+            ('feats', path.join(module.featureDir, paperpath)),
+            ('tags', path.join(module.tagDir, paperpath)),
+            ('multifiles', path.join(module.sentDir, paperpath))]
+
+def __input_files(inputpath):
+    if path.isdir(inputpath):
+        return [(fl, path.join(inputpath, fl)) for fl in sorted(listdir(inputpath))]
+    elif path.exists(inputpath):
+        return [('', inputpath)]
+    return []
+
+def input_stamp(inputs):
+    '''
+    cheap signature of the inputs (names, sizes and modification times)
+    '''
+    parts = []
+    for name, inputpath in inputs:
+        parts.append(name)
+        for fl, flpath in __input_files(inputpath):
+            st = stat(flpath)
+            parts.append('%s:%d:%d' % (fl, st.st_size, int(st.st_mtime * 1000)))
+    return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+def input_digest(inputs):
+    '''
+    digest of the contents of the inputs
+    '''
+    digest = hashlib.sha1()
+    for name, inputpath in inputs:
+        digest.update('%s\0' % name)
+        for fl, flpath in __input_files(inputpath):
+            digest.update('%s\0' % fl)
+            with open(flpath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 16), ''):
+                    digest.update(block)
+            digest.update('\0')
+    return digest.hexdigest()
+
+def paper_query(filepath):
+    '''
+    input: 1/0704.0097.txt
+    return the solr query matching every document (paragraph or formula) of the paper;
+    the / before the wildcard is escaped too, or Lucene parses it as the start of a regex
+    '''
+    paperpath = filepath[:filepath.rindex('.')]
+    return 'gpid:%s\\/*' % re_lucene_special.sub(r'\\\1', paperpath)
+
+class Manifest:
+    '''
+    Per-paper record of what was indexed: a cheap stamp and a content digest
+    of the paper's inputs (math_new, math_adj, features/feats, features/tags
+    and splitted/multifiles), and the encoder version used.
+
+    check() tells whether a paper has to be (re)indexed: the stamp is
+    compared first, and the inputs are only read when it differs.
+    '''
+    def __init__(self, manifestpath, version):
+        self.version = str(version)
+        self.db = sqlite3.connect(manifestpath, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS papers (paper TEXT PRIMARY KEY, stamp TEXT, digest TEXT, version TEXT)')
+        self.db.commit()
+
+    def check(self, module, filepath):
+        '''
+        return (changed, record); record is passed to update() once the paper is indexed
+        '''
+        inputs = paper_inputs(module, filepath)
+        stamp = input_stamp(inputs)
+        row = self.db.execute('SELECT stamp, digest, version FROM papers WHERE paper = ?', (filepath,)).fetchone()
+        if row is not None and row[2] == self.version and row[0] == stamp:
+            return False, (stamp, row[1])
+        digest = input_digest(inputs)
+        if row is not None and row[2] == self.version and row[1] == digest:
+            self.update(filepath, (stamp, digest))
+            return False, (stamp, digest)
+        return True, (stamp, digest)
+
+    def update(self, filepath, record):
+        stamp, digest = record
+        self.db.execute('INSERT OR REPLACE INTO papers (paper, stamp, digest, version) VALUES (?, ?, ?, ?)', (filepath, stamp, digest, self.version))
+
+    def papers(self):
+        return set(row[0] for row in self.db.execute('SELECT paper FROM papers'))
+
+    def remove(self, filepath):
+        self.db.execute('DELETE FROM papers WHERE paper = ?', (filepath,))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Seeded generator of synthetic formulas, in the format of the math_new cells:
+a math element whose semantics holds the presentation MathML, its content
+MathML (annotation-xml, with id attributes) and a TeX annotation.
+
+    python mathgen.py -n 1000 --seed 7 > formulas.txt
+
+Formulas vary in depth (1 to max_depth) and fan-out (1 to max_fanout
+arguments), and mix rows of identifiers, numbers and operators with
+fractions, roots, sub/superscripts, under/overscripts, fences and matrices.
+A fraction of the leaves are qvar wildcards (as in the NTCIR queries). The
+same seed and options always give the same formulas.
+'''
+import argparse
+import random
+
+IDENTIFIERS = [u'x', u'y', u'z', u'n', u'i', u'j', u'k', u'a', u'b', u'f', u'g', u'\u03b1', u'\u03b2', u'\u03bb', u'\u03c0']
+OPERATORS = [u'=', u'+', u'-', u'\u2212', u'\u00d7', u'\u2062', u'\u2061', u',', u'\u2264', u'\u2208']
+BIG_OPERATORS = [u'\u2211', u'\u220f', u'\u222b', u'lim']
+CONTENT_OPERATORS = ['plus', 'minus', 'times', 'divide', 'power', 'eq', 'leq', 'in', 'sum', 'int', 'abs', 'root']
+QVARS = [u'x', u'y', u'z', u'w']
+
+class MathMLGenerator:
+    def __init__(self, seed=0, max_depth=6, max_fanout=4, qvar_rate=0.03, matrix_rate=0.05):
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+        self.max_fanout = max_fanout
+        self.qvar_rate = qvar_rate
+        self.matrix_rate = matrix_rate
+        self.__ids = 0
+
+    def __id(self, prefix):
+        self.__ids += 1
+        return u'%s%d' % (prefix, self.__ids)
+
+    def __fanout(self):
+        return self.random.randint(1, self.max_fanout)
+
+    def presentation_leaf(self):
+        r = self.random.random()
+        if r < self.qvar_rate:
+            return u'<qvar name="%s"/>' % self.random.choice(QVARS)
+        if r < 0.5:
+            return u'<mi>%s</mi>' % self.random.choice(IDENTIFIERS)
+        if r < 0.7:
+            return u'<mn>%s</mn>' % self.random.choice([u'%d' % self.random.randint(0, 100), u'%.1f' % self.random.uniform(0, 10)])
+        return u'<mo>%s</mo>' % self.random.choice(OPERATORS)
+
+    def presentation(self, depth):
+        '''
+        return presentation MathML of at most depth levels
+        '''
+        if depth <= 1:
+            return self.presentation_leaf()
+        r = self.random.random()
+        sub = lambda: self.presentation(depth - 1)
+        if r < self.matrix_rate:
+            rows, cols = self.random.randint(1, 3), self.random.randint(1, 3)
+            return u'<mfenced open="(" close=")"><mtable>%s</mtable></mfenced>' % u''.join(
+                u'<mtr>%s</mtr>' % u''.join(u'<mtd>%s</mtd>' % self.presentation(min(depth - 1, 2)) for c in range(cols)) for row in range(rows))
+        if r < 0.4:
+            items = []
+            for i in range(self.__fanout()):
+                if items: items.append(u'<mo>%s</mo>' % self.random.choice(OPERATORS))
+                items.append(sub())
+            return u'<mrow>%s</mrow>' % u''.join(items)
+        if r < 0.55:
+            return u'<msub>%s%s</msub>' % (self.presentation_leaf(), sub())
+        if r < 0.65:
+            return u'<msup>%s%s</msup>' % (sub(), sub())
+        if r < 0.72:
+            return u'<msubsup><mo>%s</mo>%s%s</msubsup>' % (self.random.choice(BIG_OPERATORS), sub(), sub())
+        if r < 0.82:
+            return u'<mfrac>%s%s</mfrac>' % (sub(), sub())
+        if r < 0.87:
+            return u'<msqrt>%s</msqrt>' % sub()
+        if r < 0.9:
+            return u'<mroot>%s%s</mroot>' % (sub(), self.presentation_leaf())
+        if r < 0.95:
+            return u'<munderover><mo>%s</mo>%s%s</munderover>' % (self.random.choice(BIG_OPERATORS), sub(), sub())
+        return u'<mfenced>%s</mfenced>' % u''.join(sub() for i in range(self.__fanout()))
+
+    def content_leaf(self):
+        r = self.random.random()
+        if r < self.qvar_rate:
+            return u'<qvar name="%s"/>' % self.random.choice(QVARS)
+        if r < 0.6:
+            return u'<ci id="%s">%s</ci>' % (self.__id(u'c'), self.random.choice(IDENTIFIERS))
+        return u'<cn type="integer" id="%s">%d</cn>' % (self.__id(u'c'), self.random.randint(0, 100))
+
+    def content(self, depth):
+        '''
+        return content MathML of at most depth levels
+        '''
+        if depth <= 1:
+            return self.content_leaf()
+        r = self.random.random()
+        sub = lambda: self.content(depth - 1)
+        if r < self.matrix_rate:
+            rows, cols = self.random.randint(1, 3), self.random.randint(1, 3)
+            return u'<matrix id="%s">%s</matrix>' % (self.__id(u'c'), u''.join(
+                u'<matrixrow>%s</matrixrow>' % u''.join(self.content(min(depth - 1, 2)) for c in range(cols)) for row in range(rows)))
+        if r < 0.3:
+            script = self.random.choice(['subscript', 'superscript'])
+            return u'<apply id="%s"><csymbol cd="ambiguous" id="%s">%s</csymbol>%s%s</apply>' % (self.__id(u'c'), self.__id(u'c'), script, sub(), sub())
+        operator = self.random.choice(CONTENT_OPERATORS)
+        return u'<apply id="%s"><%s id="%s"/>%s</apply>' % (self.__id(u'c'), operator, self.__id(u'c'), u''.join(sub() for i in range(self.__fanout())))
+
+    def formula(self, depth=None):
+        '''
+        return a math_new mathml cell with presentation and content of the same depth
+        (random between 1 and max_depth if not given)
+        '''
+        depth = depth or self.random.randint(1, self.max_depth)
+        mathid = self.__id(u'm')
+        return (u'<math id="%s" alttext="x" display="inline"><semantics id="s%s">%s'
+                u'<annotation-xml encoding="MathML-Content" id="ax%s">%s</annotation-xml>'
+                u'<annotation encoding="application/x-tex">x</annotation></semantics></math>'
+                % (mathid, mathid, self.presentation(depth), mathid, self.content(depth))).encode('utf-8')
+
+    def formulas(self, n):
+        return [self.formula() for i in range(n)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic MathML formulas, one per line.')
+    parser.add_argument('-n', type=int, default=1000, help='number of formulas')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--max-fanout', type=int, default=4)
+    args = parser.parse_args()
+    for mathml in MathMLGenerator(args.seed, args.max_depth, args.max_fanout).formulas(args.n):
+        print mathml
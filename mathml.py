@@ -2,16 +2,19 @@ import xml.dom.minidom as dom
 import os, re
 
 def cut_nomeaning_text(mml):
-    target = [] # removing in for loop cause the problem that the node next to the removed node is skipped.
-    for child in mml.childNodes:
-        if child.nodeType == child.TEXT_NODE:
-            if re.match(r'\A\s*\Z', child.data):
-                target.append(child)
-        else:
-            cut_nomeaning_text(child)
-    for child in target:
-        mml.removeChild(child)
-        child.unlink()
+    stack = [mml]
+    while stack:
+        node = stack.pop()
+        target = [] # removing in for loop cause the problem that the node next to the removed node is skipped.
+        for child in node.childNodes:
+            if child.nodeType == child.TEXT_NODE:
+                if re.match(r'\A\s*\Z', child.data):
+                    target.append(child)
+            else:
+                stack.append(child)
+        for child in target:
+            node.removeChild(child)
+            child.unlink()
     return
 
 def parse_file(path):
@@ -8,8 +8,9 @@ class CErrorException(Exception):
     pass
 
 class MathMLContent:
-    parser = etree.XMLParser(remove_blank_text=True, encoding='UTF-8')
+    parser = etree.XMLParser(remove_blank_text=True, encoding='UTF-8', huge_tree=True)
     re_node_text = r'\s'
+    re_position = re.compile(r'\d+(#)')
 
     def __getText(self, text):
         return re.sub(self.re_node_text, '_', text)
@@ -33,54 +34,115 @@ class MathMLContent:
             return u'%s' % node.tag
         return u':'.join(text_content(child) for child in node)
 
+    def __encode_node(self, root):
+        '''
+        return the encoding of root without its children, and the children to encode
+        '''
+        if root.tag == u'cerror':
+            return [u'cerror'], list(root)
+        elif len(root) == 0:
+            return self.__content(root), []
+        else:# root.tag == u'apply':
+            if len(root) > 0 and len(root[0]) == 0:
+                return [self.__text_content(root[0])], root[1:]
+            return [u'%s' % root.tag], list(root)
+
     def __encode_subtree(self, root):
-        try:
-            if root.tag == u'cerror':
-                return [u'cerror'] + [self.__encode_subtree(child) for child in root]
-            elif len(root) == 0:
-                return self.__content(root)
-            else:# root.tag == u'apply':
-                if len(root) > 0 and len(root[0]) == 0:
-                    return [self.__text_content(root[0])] + [self.__encode_subtree(child) for child in root[1:]]
-                return [u'%s' % root.tag] + [self.__encode_subtree(child) for child in root]
-        except:
-            return []
+        #walks the tree with an explicit stack; each node fills its own list, children are appended as empty lists and filled in turn
+        tree = []
+        stack = [(root, tree)]
+        while stack:
+            node, encoded = stack.pop()
+            try:
+                head, children = self.__encode_node(node)
+            except:
+                continue
+            encoded.extend(head)
+            for child in children:
+                encoded_child = []
+                encoded.append(encoded_child)
+                stack.append((child, encoded_child))
+        return tree
 
     def encode_mathml_as_tree(self, string):
         doc = etree.fromstring(string, self.parser)
         cmathmls = doc.findall(u'.//annotation-xml')
         return [self.__encode_subtree(cmathml[0]) for cmathml in cmathmls if len(cmathml) > 0], [etree.tostring(cmathml) for cmathml in cmathmls if len(cmathml) > 0]
 
+    def encode_formula_as_tree(self, formula):
+        '''
+        same as encode_mathml_as_tree, on the annotation-xml elements already collected by formula.Formula
+        returns the annotation-xml elements themselves instead of their serialization
+        '''
+        return [self.__encode_subtree(cmathml[0]) for cmathml in formula.content], formula.content
+
     def encode_paths(self, tree):
-        global_ooper = []
-        global_oarg = []
-        def encode_paths_inner(tree):
-            ooper = []
-            oarg = []
-            #if tree[0] == u'cn' or tree[0] == 'ci': #need to extend to support nodes (besides cn and ci) that are leaves
-            if len(tree) == 2 and all(type(elem) is unicode for elem in tree):
-                ooper.append(tree[0])
-                oarg.append(u'#'.join(tree))
-            else:
-                if len(tree) > 1:
-                    for index, child in enumerate(tree[1:], start=1):
-                        child_ooper, child_oarg = encode_paths_inner(child)
-                        ooper.extend("%s#%s#%s" % (tree[0], index, e) for e in child_ooper)
-                        oarg.extend("%s#%s#%s" % (tree[0], index, e) for e in child_oarg)
-                else:
-                    ooper.append(tree[0])
-            global_ooper.extend(ooper)
-            global_oarg.extend(oarg)
-            return ooper, oarg
-
-        encode_paths_inner(tree)
-        return global_ooper, global_oarg
+        ooper, oarg, uoper, uarg = self.__walk_paths(tree, False)
+        return ooper, oarg
+
+    def encode_all_paths(self, tree):
+        '''
+        return ooper, oarg, uoper, uarg: the paths of encode_paths and their get_unordered_paths, in one walk
+        '''
+        return self.__walk_paths(tree, True)
+
+    def __walk_paths(self, tree, unordered):
+        #explicit stack of [tree, index of the child being encoded, (ooper, oarg, uoper, uarg)]; the paths of
+        #a subtree are added to the globals when it is done, then added to its parent behind the prefix
+        #head#index# (head## unordered: a path never goes through the regex again once its leaf is done)
+        global_paths = ([], [], [], [])
+        uprefixes = {}
+        stack = [self.__enter_paths(tree, unordered)]
+        while stack:
+            frame = stack[-1]
+            tree, index, paths = frame
+            if index < len(tree):
+                stack.append(self.__enter_paths(tree[index], unordered))
+                continue
+            stack.pop()
+            for global_path, path in zip(global_paths, paths):
+                global_path.extend(path)
+            if stack:
+                parent = stack[-1]
+                head = parent[0][0]
+                prefix = "%s#%s#" % (head, parent[1])
+                parent_paths = parent[2]
+                parent_paths[0].extend([prefix + e for e in paths[0]])
+                parent_paths[1].extend([prefix + e for e in paths[1]])
+                if unordered:
+                    uprefix = uprefixes.get(head)
+                    if uprefix is None:
+                        uprefix = uprefixes[head] = self.__unordered("%s#" % head) + '#'
+                    parent_paths[2].extend([uprefix + e for e in paths[2]])
+                    parent_paths[3].extend([uprefix + e for e in paths[3]])
+                parent[1] += 1
+        return global_paths
+
+    def __enter_paths(self, tree, unordered):
+        paths = ([], [], [], [])
+        #if tree[0] == u'cn' or tree[0] == 'ci': #need to extend to support nodes (besides cn and ci) that are leaves
+        if len(tree) == 2 and all(type(elem) is unicode for elem in tree):
+            paths[0].append(tree[0])
+            paths[1].append(u'#'.join(tree))
+            if unordered:
+                paths[2].append(self.__unordered(paths[0][0]))
+                paths[3].append(self.__unordered(paths[1][0]))
+            return [tree, len(tree), paths]
+        elif len(tree) > 1:
+            return [tree, 1, paths]
+        paths[0].append(tree[0])
+        if unordered:
+            paths[2].append(self.__unordered(tree[0]))
+        return [tree, len(tree), paths]
+
+    def __unordered(self, path):
+        return self.re_position.sub(r'\1', path) if '#' in path else path
 
     def get_unordered_paths(self, ordered_paths):
         '''
         ordered_paths is a set : set([path1, path2])
         '''
-        return map(lambda path: re.sub(r'\d+(#)', r'\1', path), list(ordered_paths))
+        return map(lambda path: self.re_position.sub(r'\1', path), list(ordered_paths))
                 
 """
 <annotation-xml encoding="MathML-Content" id="I1.i2.p1.1.m5.1.cmml" xref="I1.i2.p1.1.m5.1">
@@ -1,133 +1,47 @@
 #location will be in pymathcat
 from mathml_presentation_nosnuggle import MathMLPresentation
 from mathml_content import MathMLContent, CErrorException
-import subtree, sigure, modular
-from os import listdir, path
+from formula import iter_formulas, encodePresentation, encodeContent, encodeFormulas
+from cache import formula_digest
+from reader import read_lines_at, index_lines, iter_groups, ParagraphLRU, getUnicodeText, getDep, getDepFromLines, extractDescription, extractContext, lazyContext, lazyDescription
+from depgraph import DependencyGraph
+from stagetimer import NULL_TIMER
+from os import path
+from itertools import izip
 from sys import argv
-import re
 import solr
+from uploader import BatchUploader
 
-kmcsregex = r'(__(?:PRE|CODE|SPAN|FIGURE|TABLE|DIV|MATH)_\d+__)'
 mathDir = '../mathmlandextra/math_new/'
 mathadjDir = '../mathmlandextra/math_adj/'
 featureDir = '../features/feats/'
 tagDir = '../features/tags/'
 sentDir = '../splitted/multifiles/' #'maths/sentence'
-
-def getCleanSentence(sentence):
-    ms = re.findall(kmcsregex, sentence)
-    for m in ms: 
-        sentence = sentence.replace(m, '')
-    return sentence, ms
-
-def getUnicodeText(string):
-    if type(string) is str:
-        return string.decode('utf-8')
-    else:
-        return string
-
-def getDep(filename):
-    '''
-    input: file in math_adj
-    use new heuristics, no need to take the longest first
-    '''
-    adj = {} #{mathid: [child1, child2]}
-    for ln in open(filename).readlines():
-        midparent, midchildren = ln.strip().split('\t')
-        mids = midchildren.split(' ')
-        for idx in reversed(range(len(mids))):
-            if 'xhtml' not in mids[idx]:
-                mids[idx - 1] += ' %s' % mids[idx]
-                del mids[idx]
-        adj[midparent] = mids
-    return adj
-
-def extractDescription(featurepaper, tagpaper):
-    '''
-    input: tags/6/0812.0981 and features/6/0812.0981
-    Paraname + kmcs-id is enough to be the key, since sentence for extractoion replace XML elements with kmcs-id
-    return dictionary which its key is mathID triple and its value is description
-    '''
-    desc = {} #{(para, kmcsid): [desc1, desc2]}
-    for fl in listdir(tagpaper):
-        taglns = open(path.join(tagpaper, fl)).readlines()
-        fetlns = open(path.join(featurepaper, fl).replace('arff', 'txt')).readlines()
-        for idx, ln in enumerate(taglns):
-            if ln.startswith('True'):
-               fetcells = fetlns[idx].strip().split('\t')
-               description = getUnicodeText(getCleanSentence(' '.join(fetcells[1:]))[0])
-               if (fl, fetcells[0]) in desc:
-                   desc[(fl.replace('arff', 'txt'), fetcells[0])].append(description)
-               else:
-                   desc[(fl.replace('arff', 'txt'), fetcells[0])] = [description]
-    #get unique value, overlap will be considered as unique
-    for k in desc.iterkeys():
-        desc[k] = list(set(desc[k]))
-    return desc
-
-def extractContext(sentencepaper):
-    '''
-    input: splitted/multifiles/6/0812.0981
-    return dictionary which its key is mathID triple and its value is context
-    '''
-    context = {}
-    for fl in listdir(sentencepaper):
-        lns = open(path.join(sentencepaper, fl)).readlines()
-        for ln in lns:
-            cleansent, matches = getCleanSentence(ln.strip())
-            for m in matches:
-                if (fl, m) in context: print 'double kmcs-id'
-                context[(fl, m)] = getUnicodeText(cleansent)
-    return context
-    
-
-def encodePresentation(procPres, mathml):
-    semantics, mts_string, mts_presentation = procPres.get_doc_with_orig(mathml)
-    opaths = []
-    upaths = []
-    sisters = []
-    subhash = []
-    sighash = []
-    modhash = []
-    if semantics is not None:
-        opaths, sisters = procPres.get_ordered_paths_and_sisters(semantics, False)
-        upaths = map(lambda paths: ' '.join(map(getUnicodeText, paths)), procPres.get_unordered_paths(opaths))
-        sisters = map(lambda family: ' '.join(map(getUnicodeText, family)), sisters)
-        opaths = map(lambda paths: ' '.join(map(getUnicodeText, paths)), opaths) 
-        subhash = subtree.hash_string(mts_presentation)
-        sighash = sigure.hash_string(mts_presentation)
-        modhash = modular.hash_string_generator(2 ** 32)(mts_presentation)
-    return opaths, upaths, sisters, subhash, sighash, modhash
-
-def encodeContent(procCont, mathml):
-    oopers = []
-    oargs = []
-    uopers = []
-    uargs = []
-    trees, cmathmls_str = procCont.encode_mathml_as_tree(mathml)
-    for tree in trees:
-        ooper, oarg = procCont.encode_paths(tree)
-        uoper = procCont.get_unordered_paths(ooper)
-        uarg = procCont.get_unordered_paths(oarg)
-        oopers.extend(map(getUnicodeText, ooper))
-        oargs.extend(map(getUnicodeText, oarg))
-        uopers.extend(map(getUnicodeText, uoper))
-        uargs.extend(map(getUnicodeText, uarg))
-    subhash = []
-    sighash = []
-    modhash = []
-    for cmathml_str in cmathmls_str:
-        subhash.extend(subtree.hash_string(cmathml_str))
-        sighash.extend(sigure.hash_string(cmathml_str))
-        modhash.extend(modular.hash_string_generator(2 ** 32)(cmathml_str))
-    return oopers, oargs, uopers, uargs, subhash, sighash, modhash
-
-
-def encode_file(filepath, solr):
-    procPres = MathMLPresentation('http://localhost:9000')
-    procCont = MathMLContent()
+snuggleUrl = 'http://localhost:9000'
+solrUrl = 'http://localhost:9000/solr/mcd.20150129'
+#dedup mode (encode_file(dedup=True)): the fields of a formula are stored once, in a formula document,
+#and its occurrence documents refer to it by formulaIdField
+formulaIdField = 'formula_id'
+formulaFields = ['mathml', 'opaths', 'upaths', 'sisters', 'subtree_presentation', 'sigure_presentation', 'modular_presentation',
+                 'ooper', 'oarg', 'uoper', 'uarg', 'subtree_content', 'sigure_content', 'modular_content',
+                 'minhash_presentation', 'minhash_content', 'lsh_presentation', 'lsh_content']
+
+def encode_file(filepath, solr, procPres=None, procCont=None, cache=None, sidecar=None, timer=None, minhash=None, dedup=False, emitted=None, added=None, dep_depth=1):
+    procPres = procPres or MathMLPresentation(snuggleUrl)
+    procCont = procCont or MathMLContent()
+    timer = timer or NULL_TIMER
+    if dedup and emitted is None:
+        emitted = set()
+    if dedup and added is None:
+        added = emitted
     '''
     input: 1/0705.0912.txt
+    minhash: a minhash.MinHasher, to add the signatures and LSH band keys of the subtree values
+    dedup: store the mathml, paths and hash values of a formula once, in a formula document (see encodeParagraph)
+    emitted: in dedup mode, the digests of the formula documents solr already has
+    added: in dedup mode, the set the digests of the formula documents sent are added to, emitted by default
+    (the indexer adds them to emitted once the paper is flushed)
+    dep_depth: levels of the dependency graph in context_children and description_children (see depgraph)
     For each math:
     1. get the related maths by look at createNewDep return value.
     2. get its own description
@@ -143,14 +57,78 @@ def encode_file(filepath, solr):
     tagfl = path.join(tagDir, paperpath)
     sentfl = path.join(sentDir, paperpath)
 
-    adj = getDep(mathadjfl)
-    contextDict = extractContext(sentfl)
-    descDict = extractDescription(featurefl, tagfl)
-
+    #from the sidecar (see sidecar.py) if the paper is in it
+    deps = None
+    if sidecar is not None and sidecar.paragraphs(paperpath) is not None:
+        contextDicts = sidecar.contexts(paperpath)
+        descDicts = sidecar.descriptions(paperpath)
+        deps = sidecar.dependencies(paperpath, dep_depth)
+    else:
+        contextDicts = lazyContext(sentfl, timer)
+        descDicts = lazyDescription(featurefl, tagfl, timer)
+    #math_new and math_adj are read one paragraph at a time, context and descriptions on demand
+    if deps is None:
+        with timer.stage('read'):
+            adjIndex = index_lines(mathadjfl, lambda ln: ln.split('#', 1)[0])
+        adjacency = ParagraphLRU(timer.timed('dep', lambda paraname: getDepFromLines(read_lines_at(mathadjfl, adjIndex.get(paraname)))))
+        deps = DependencyGraph(adjacency, contextDicts, descDicts, dep_depth)
+
+    for paraname, mathlns in timer.iterate('read', iter_groups(mathfl, lambda ln: ln.split('\t')[1])):
+        docs = encodeParagraph(paperpath, mathlns, deps, procPres, procCont, cache, timer, minhash, emitted if dedup else None, added)
+        with timer.stage('upload'):
+            solr.add_many(docs)
+        timer.count('docs', len(docs))
+
+def addFormulaFields(doc, encoding):
+    (opaths, upaths, sisters, psubhash, psighash, pmodhash), (oopers, oargs, uopers, uargs, csubhash, csighash, cmodhash) = encoding
+    if len(psubhash) > 0:
+        doc["opaths"] = opaths
+        doc["upaths"] = upaths
+        doc["sisters"] = sisters
+        doc["subtree_presentation"] = psubhash
+        doc["sigure_presentation"] = psighash
+        doc["modular_presentation"] = pmodhash
+    if len(csubhash) > 0:
+        doc["ooper"] = oopers
+        doc["oarg"] = oargs
+        doc["uoper"] = uopers
+        doc["uarg"] = uargs
+        doc["subtree_content"] = csubhash
+        doc["sigure_content"] = csighash
+        doc["modular_content"] = cmodhash
+
+def encodeParagraph(paperpath, mathlns, deps, procPres, procCont, cache=None, timer=NULL_TIMER, minhash=None, emitted=None, added=None):
+    '''
+    return the documents of the formulas in mathlns, the math_new lines of a paragraph
+    deps: the depgraph.DependencyGraph of the paper, for the texts of the formulas and of their children
+    emitted: dedup mode, the digests of the formula documents already stored. An occurrence document then refers
+    to its formula by formula_id, and a formula document is returned for the formulas neither in emitted nor in added
+    added: dedup mode, the digests of the formula documents returned are added to it (emitted by default)
+    '''
     docs = []
-    
-    mathlns = open(mathfl).readlines()
-    for ln in mathlns:
+    digests = None
+    encodeIndexes = range(len(mathlns))
+    if emitted is not None:
+        added = emitted if added is None else added
+        digests = [formula_digest('\t'.join(ln.split('\t')[3:])) for ln in mathlns]
+        new = set()
+        encodeIndexes = [i for i, digest in enumerate(digests) if not (digest in emitted or digest in added or digest in new or new.add(digest))]
+    with timer.stage('parse'):
+        formulas = list(iter_formulas(procPres, [mathlns[i] for i in encodeIndexes], cache=cache))
+    encodings = iter(encodeFormulas(procPres, procCont, [(formula, presentation_doc) for ln, formula, presentation_doc, encoding in formulas if encoding is None], timer))
+    lineEncodings = [None] * len(mathlns)
+    for i, (ln, formula, presentation_doc, encoding) in izip(encodeIndexes, formulas):
+        cached = encoding is not None
+        if encoding is None:
+            encoding = next(encodings)
+            if cache is not None: cache.put('\t'.join(ln.split('\t')[3:]), encoding)
+        lineEncodings[i] = encoding
+        if timer.enabled:
+            (opaths, upaths, sisters, psubhash, psighash, pmodhash), (oopers, oargs, uopers, uargs, csubhash, csighash, cmodhash) = encoding
+            if cached: timer.count('cache_hits')
+            timer.count('paths', sum(map(len, [opaths, upaths, sisters, oopers, oargs, uopers, uargs])))
+            timer.count('hash_values', sum(map(len, [psubhash, psighash, pmodhash, csubhash, csighash, cmodhash])))
+    for i, ln in enumerate(mathlns):
         cells = ln.split('\t')
         paraname = cells[1]
         parapath = path.join(paperpath, paraname)
@@ -160,28 +138,34 @@ def encode_file(filepath, solr):
         gmid = getUnicodeText('#'.join([parapath, kmcsid, latexmlid]))
         mid ='#'.join([paraname, kmcsid, latexmlid])
         mathml = '\t'.join(cells[3:])
-        
-        opaths, upaths, sisters, psubhash, psighash, pmodhash = encodePresentation(procPres, mathml)
-        oopers, oargs, uopers, uargs, csubhash, csighash, cmodhash = encodeContent(procCont, mathml)
-
-        textdictid = tuple([paraname.replace('xhtml', 'txt'), kmcsid])
-        context = contextDict[textdictid] if textdictid in contextDict else '' # a string
-        descs = descDict[textdictid] if textdictid in descDict else [] # a list of string
+        encoding = lineEncodings[i]
+        timer.count('formulas')
 
-        children = adj[mid] if mid in adj else []
-        context_children = [] # a list of string
-        desc_children = []
-        for child in children:
-            paraname_child, kmcsid_child, latexmlid_child = child.split('#')
-            textdictchildid = tuple([paraname_child.replace('xhtml', 'txt'), kmcsid_child])
-            if textdictchildid in contextDict: context_children.append(contextDict[textdictchildid])
-            if textdictchildid in descDict: desc_children.extend(descDict[textdictchildid])
+        context, descs = deps.texts(mid)
+        context = context or '' # a string
+        context_children, desc_children = deps.children(mid) # lists of string
 
         #TODO: push the gmid, math-related, and text-related data to lucene
         doc = {"gmid": gmid, 
                "gpid": parapath, 
-               "mathml": mathml,
         }
+        if digests is None:
+            doc["mathml"] = mathml
+        else:
+            doc[formulaIdField] = digests[i]
+            if encoding is None:
+                timer.count('formula_refs')
+            else:
+                added.add(digests[i])
+                formula_doc = {"gmid": formulaDocId(digests[i]),
+                               formulaIdField: digests[i],
+                               "mathml": mathml,
+                }
+                addFormulaFields(formula_doc, encoding)
+                if minhash is not None:
+                    with timer.stage('minhash'):
+                        minhash.add_fields(formula_doc)
+                docs.append(formula_doc)
         if context.strip() != '':
             doc["context_en"] = [context]
             doc["context_xhtml"] = [context]
@@ -192,30 +176,58 @@ def encode_file(filepath, solr):
             doc["context_children"] = context_children
         if len(desc_children) > 0:
             doc["description_children"] = desc_children
-        if len(psubhash) > 0:
-            doc["opaths"] = opaths
-            doc["upaths"] = upaths
-            doc["sisters"] = sisters
-            doc["subtree_presentation"] = psubhash
-            doc["sigure_presentation"] = psighash
-            doc["modular_presentation"] = pmodhash
-        if len(csubhash) > 0:
-            doc["ooper"] = oopers
-            doc["oarg"] = oargs
-            doc["uoper"] = uopers
-            doc["uarg"] = uargs
-            doc["subtree_content"] = csubhash
-            doc["sigure_content"] = csighash
-            doc["modular_content"] = cmodhash
+        if digests is None:
+            addFormulaFields(doc, encoding)
+            if minhash is not None:
+                with timer.stage('minhash'):
+                    minhash.add_fields(doc)
         docs.append(doc)
-    solr.add_many(docs)
+    return docs
+
+formulaDocPrefix = u'formula#'
+
+def formulaDocId(formula_id):
+    return formulaDocPrefix + formula_id
+
+def joinQuery(query):
+    '''
+    input: a query on the fields of the formula documents (dedup mode), e.g. 'subtree_content:(12 OR 34)'
+    return a query matching the occurrence documents of the formulas it matches (a Solr join within the core,
+    the formula documents themselves excluded), to combine with the text fields:
+    q=description_en:energy&fq=joinQuery(...)
+    '''
+    join = u'{!join from=%s to=%s}%s' % (formulaIdField, formulaIdField, query)
+    return u'+_query_:"%s" -gmid:%s*' % (join.replace(u'\\', u'\\\\').replace(u'"', u'\\"'), formulaDocPrefix)
+
+def expandDocs(conn, docs, fields=formulaFields, batch=100):
+    '''
+    conn: a solr.SolrConnection of a dedup mode index
+    return docs (occurrence documents, e.g. query results) with the fields of their formula documents added
+    '''
+    formula_ids = sorted(set(doc[formulaIdField] for doc in docs if formulaIdField in doc))
+    formula_docs = {}
+    for start in range(0, len(formula_ids), batch):
+        ids = formula_ids[start:start + batch]
+        query = u'gmid:(%s)' % u' OR '.join(u'"%s"' % formulaDocId(formula_id) for formula_id in ids)
+        for formula_doc in conn.query(query, fields=[formulaIdField] + fields, score=False, rows=len(ids)).results:
+            formula_docs[formula_doc[formulaIdField]] = formula_doc
+    expanded = []
+    for doc in docs:
+        doc = dict(doc)
+        for field in fields:
+            if field in formula_docs.get(doc.get(formulaIdField), {}):
+                doc[field] = formula_docs[doc[formulaIdField]][field]
+        expanded.append(doc)
+    return expanded
+
 
 if __name__ == '__main__':
-    s = solr.SolrConnection('http://localhost:9000/solr/mcd.20150129')
+    s = BatchUploader(solr.SolrConnection(solrUrl))
     inp = argv[1]
     filepath = path.relpath(inp, '.')
     try:
         encode_file(filepath, s)
+        s.close()
     except:
         print filepath + ' error'
 
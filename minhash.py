@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+MinHash signatures and LSH band keys of the subtree hash sets, for
+near-duplicate formula search.
+
+A signature summarizes the subtree_presentation (or subtree_content) values
+of a document in num_perm minimums of random hash functions; the fraction of
+equal positions of two signatures estimates the Jaccard similarity of the two
+sets. The signature is cut into bands of num_perm / bands rows, and every band
+is hashed to one key: two documents sharing a key are candidates. With r rows
+per band, documents of similarity s share a key with probability
+1 - (1 - s^r)^bands, which turns around (1 / bands)^(1 / r), 0.5 for the default
+64x16.
+
+The encoders add the fields when given a MinHasher (indexer.py --minhash 64x16):
+
+    minhash_presentation, minhash_content   the signatures (ints < 2^32)
+    lsh_presentation, lsh_content           the band keys (signed 64-bit ints)
+
+so that Solr answers a similarity query with a few term lookups on the lsh
+field instead of the whole subtree list. The hash functions only depend on the
+spec and the seed: queries have to use the spec the index was built with
+(queryserver.py --minhash).
+
+LSHIndex is the local counterpart, for offline near-duplicate detection over
+exported segments (indexer.py --export); documents exported without the
+minhash fields are signed from their subtree values:
+
+    python minhash.py duplicates export --threshold 0.8
+    python minhash.py query export MATHML
+'''
+import argparse
+import hashlib
+import random
+import struct
+import sys
+import time
+from itertools import combinations
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from hashindex import hash_value, query_paper, read_segments
+
+PRIME = (1 << 61) - 1
+MASK = 0xFFFFFFFFFFFFFFFF
+MAX_HASH = 0xFFFFFFFF
+KINDS = ('presentation', 'content')
+
+class MinHasher:
+    '''
+    num_perm hash functions (a * x + b) mod 2^64 mod PRIME, truncated to 32
+    bits, drawn from seed; the values are first folded to 32 bits.
+    '''
+    def __init__(self, num_perm=64, bands=16, seed=1):
+        if num_perm <= 0 or bands <= 0 or num_perm % bands != 0:
+            raise ValueError('the number of bands has to divide the signature size: %dx%d' % (num_perm, bands))
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.seed = seed
+        generator = random.Random(seed)
+        self.permutations = [(generator.randint(1, PRIME - 1), generator.randint(0, PRIME - 1)) for i in range(num_perm)]
+        if np is not None:
+            self.__a = np.array([a for a, b in self.permutations], dtype=np.uint64)[:, None]
+            self.__b = np.array([b for a, b in self.permutations], dtype=np.uint64)[:, None]
+
+    @classmethod
+    def parse(cls, spec):
+        '''
+        input: 'num_perm' or 'num_permxbands', e.g. '64x16'
+        '''
+        try:
+            sizes = [int(size) for size in spec.lower().split('x')]
+            return cls(*sizes[:2])
+        except (ValueError, TypeError):
+            raise ValueError('invalid minhash spec: %s (e.g. 64x16)' % spec)
+
+    def __str__(self):
+        spec = '%dx%d' % (self.num_perm, self.bands)
+        return spec if self.seed == 1 else '%s:%d' % (spec, self.seed)
+
+    def __repr__(self):
+        return 'MinHasher(%d, %d, %d)' % (self.num_perm, self.bands, self.seed)
+
+    def signature(self, values):
+        '''
+        values: hash values (see hashindex.hash_value). return the signature, [] if values is empty
+        '''
+        folded = set()
+        for value in values:
+            value = hash_value(value) & MASK
+            folded.add((value ^ (value >> 32)) & MAX_HASH)
+        if not folded:
+            return []
+        if np is not None:
+            x = np.fromiter(folded, dtype=np.uint64, count=len(folded))[None, :]
+            with np.errstate(over='ignore'):
+                return (((self.__a * x + self.__b) % PRIME) & MAX_HASH).min(axis=1).tolist()
+        return [min(((a * x + b) & MASK) % PRIME & MAX_HASH for x in folded) for a, b in self.permutations]
+
+    def band_keys(self, signature):
+        '''
+        return the key of every band of signature, [] for an empty signature
+        '''
+        if not signature:
+            return []
+        keys = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows:(band + 1) * self.rows]
+            digest = hashlib.md5(struct.pack('<I%dI' % self.rows, band, *rows)).digest()
+            keys.append(struct.unpack('<q', digest[:8])[0])
+        return keys
+
+    def add_fields(self, doc):
+        '''
+        add the signature and band keys of the subtree values of doc, for both kinds
+        '''
+        for kind in KINDS:
+            signature = self.signature(doc.get('subtree_' + kind, []))
+            if signature:
+                doc['minhash_' + kind] = signature
+                doc['lsh_' + kind] = self.band_keys(signature)
+
+def similarity(signature1, signature2):
+    '''
+    estimated Jaccard similarity of the sets of two signatures
+    '''
+    if not signature1 or len(signature1) != len(signature2):
+        return 0.0
+    return sum(1 for x, y in zip(signature1, signature2) if x == y) / float(len(signature1))
+
+class LSHIndex:
+    '''
+    In-memory LSH index: documents are found through the band keys they share
+    with a query, then ranked by estimated similarity.
+    '''
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.ids = []
+        self.signatures = []
+        self.buckets = {} # band key : document numbers
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, docid, signature, keys=None):
+        if len(signature) != self.hasher.num_perm:
+            raise ValueError('signature of %d values for a %s index' % (len(signature), self.hasher))
+        docnum = len(self.ids)
+        self.ids.append(docid)
+        self.signatures.append(signature)
+        for key in keys if keys is not None else self.hasher.band_keys(signature):
+            self.buckets.setdefault(key, []).append(docnum)
+
+    def candidates(self, signature):
+        '''
+        return the document numbers sharing at least one band key with signature
+        '''
+        docnums = set()
+        for key in self.hasher.band_keys(signature):
+            docnums.update(self.buckets.get(key, []))
+        return docnums
+
+    def query(self, signature, threshold=0.0, limit=10):
+        '''
+        return [(id, estimated similarity)] of the candidates of signature reaching threshold, best first
+        '''
+        results = []
+        for docnum in self.candidates(signature):
+            score = similarity(signature, self.signatures[docnum])
+            if score >= threshold:
+                results.append((-score, docnum))
+        results.sort()
+        return [(self.ids[docnum], -score) for score, docnum in results[:limit]]
+
+    def near_duplicates(self, threshold=0.8, max_bucket=None):
+        '''
+        yield (id, id, estimated similarity) once for every pair of candidates reaching threshold.
+        buckets of more than max_bucket documents (very common formulas) are skipped
+        '''
+        seen = set()
+        for docnums in self.buckets.itervalues():
+            if len(docnums) < 2 or (max_bucket is not None and len(docnums) > max_bucket):
+                continue
+            for pair in combinations(docnums, 2):
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                score = similarity(self.signatures[pair[0]], self.signatures[pair[1]])
+                if score >= threshold:
+                    yield self.ids[pair[0]], self.ids[pair[1]], score
+
+def load_segments(directory, hasher, kind='content', id_field='gmid'):
+    '''
+    return an LSHIndex of the kind signatures of the documents exported to directory, after
+    the replacements and delete queries of the segments (see hashindex.build)
+    '''
+    signatures = {} # id : (paper path, signature, band keys)
+    papers = {} # paper path : ids
+    for command in read_segments(directory):
+        if 'delete' in command:
+            for docid in papers.pop(query_paper(command['delete']['query']), []):
+                signatures.pop(docid, None)
+            continue
+        doc = command['add']['doc']
+        docid = doc.get(id_field)
+        if isinstance(docid, list):
+            docid = docid[0] if docid else None
+        if docid is None:
+            continue
+        signature = doc.get('minhash_' + kind)
+        if signature is not None and len(signature) == hasher.num_perm:
+            keys = doc.get('lsh_' + kind)
+        else:
+            signature = hasher.signature(doc.get('subtree_' + kind, []))
+            keys = None
+        if not signature:
+            signatures.pop(docid, None)
+            continue
+        paper = doc.get('gpid', '').rsplit('/', 1)[0]
+        papers.setdefault(paper, []).append(docid)
+        signatures[docid] = (paper, signature, keys)
+    index = LSHIndex(hasher)
+    for docid in sorted(signatures):
+        paper, signature, keys = signatures[docid]
+        index.add(docid, signature, keys)
+    return index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Near-duplicate formulas by MinHash/LSH over exported segments.')
+    parser.add_argument('--minhash', type=MinHasher.parse, default=MinHasher(), help='signature size and bands, as indexed (default 64x16)')
+    parser.add_argument('--kind', choices=KINDS, default='content', help='subtree values the signatures are computed on')
+    parser.add_argument('--id-field', default='gmid', help='document field reported (gpid for the paragraph encoder)')
+    commands = parser.add_subparsers(dest='command')
+    duplicates_parser = commands.add_parser('duplicates', help='print the pairs of near-duplicate documents')
+    duplicates_parser.add_argument('segments', help='directory of the segments (indexer.py --export)')
+    duplicates_parser.add_argument('-t', '--threshold', type=float, default=0.8, help='minimum estimated similarity')
+    duplicates_parser.add_argument('--max-bucket', type=int, help='skip the band keys shared by more documents than this')
+    query_parser = commands.add_parser('query', help='print the documents most similar to a query mathml')
+    query_parser.add_argument('segments')
+    query_parser.add_argument('mathml', help='query mathml, - for stdin')
+    query_parser.add_argument('-e', '--encoder', default='description', help='encoder the segments were exported with')
+    query_parser.add_argument('-t', '--threshold', type=float, default=0.0)
+    query_parser.add_argument('-n', '--limit', type=int, default=10)
+    args = parser.parse_args()
+    start = time.time()
+    index = load_segments(args.segments, args.minhash, args.kind, args.id_field)
+    sys.stderr.write('%d signatures, %d band keys in %.1f s\n' % (len(index), len(index.buckets), time.time() - start))
+    start = time.time()
+    if args.command == 'duplicates':
+        pairs = 0
+        for id1, id2, score in index.near_duplicates(args.threshold, args.max_bucket):
+            print '%s\t%s\t%.3f' % (id1.encode('utf-8'), id2.encode('utf-8'), score)
+            pairs += 1
+        sys.stderr.write('%d pairs in %.1f s\n' % (pairs, time.time() - start))
+    else:
+        from queryserver import QueryEncoder
+        mathml = sys.stdin.read() if args.mathml == '-' else args.mathml
+        terms = QueryEncoder(args.encoder).encode(mathml)
+        for docid, score in index.query(args.minhash.signature(terms['subtree_' + args.kind]), args.threshold, args.limit):
+            print '%s\t%.3f' % (docid.encode('utf-8'), score)
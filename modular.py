@@ -4,20 +4,21 @@
 from xml.dom import minidom
 from ctypes import c_longlong
 from mathml import cut_nomeaning_text, parse_file
+from symhash import symbol_hash
 
 def hash_leaf(mml_elem):
     # mml_elem : minidom mml element that has no children.
     # returns : hash value singleton.
     if mml_elem.nodeType == mml_elem.TEXT_NODE:
-        var = hash(mml_elem.data)
+        var = symbol_hash(mml_elem.data)
     else:
-        var = hash(mml_elem.localName)
+        var = symbol_hash(mml_elem.localName)
     return var, []
 
 def hash_qvar(mml_elem):
     # mml_elem : minidom mml element that tag name is qvar (defined in NTCIR11-Math nc)
     # returns : hash value singleton
-    return hash(mml_elem.getAttribute('name')), []
+    return symbol_hash(mml_elem.getAttribute('name')), []
 
 def hash_apply(mml_elem, args, dup_param):
     # mml_elem : minidom mml element object which tagName equals to "apply".
@@ -39,7 +40,7 @@ def hash_node(mml_elem, args, dup_param):
     # mml_elem : minidom mml internal node.
     # args : hash values from children nodes.
     # returns : hashed value
-    av = hash(mml_elem.localName)
+    av = symbol_hash(mml_elem.localName)
     var = c_longlong(0)
     a = av | 1
     for arg in args:
@@ -50,18 +51,27 @@ def hash_node(mml_elem, args, dup_param):
 def hash_recursion(mml_elem, dup_param):
     # mml_elem : minidom mml element object.
     # returns : hash value set for the subtree rooted at mml_elem.
+    # walks the tree with an explicit stack of (internal node, children iterator, args).
     if mml_elem.localName == "qvar" : return hash_qvar(mml_elem)
     if not mml_elem.hasChildNodes(): return hash_leaf(mml_elem)
 
-    args, subs = [], []
-    for childNode in mml_elem.childNodes:
-        arg, sub = hash_recursion(childNode, dup_param)
-        args.append(arg)
-        subs += sub
-    if mml_elem.localName == "apply" : var = hash_apply(mml_elem, args, dup_param)        
-    else: var = hash_node(mml_elem, args, dup_param)
+    res = []
+    stack = [(mml_elem, iter(mml_elem.childNodes), [])]
+    while stack:
+        elem, children, args = stack[-1]
+        childNode = next(children, None)
+        if childNode is not None:
+            if childNode.localName == "qvar" : args.append(hash_qvar(childNode)[0])
+            elif not childNode.hasChildNodes(): args.append(hash_leaf(childNode)[0])
+            else: stack.append((childNode, iter(childNode.childNodes), []))
+            continue
+        stack.pop()
+        res.extend(args)
+        if elem.localName == "apply" : var = hash_apply(elem, args, dup_param)
+        else: var = hash_node(elem, args, dup_param)
+        if stack: stack[-1][2].append(var)
 
-    return var, subs + args
+    return var, res
 
 def hash_mml(mml, dup_param):
     # mml : minidom mml object (top is m:math or math).
@@ -1,89 +1,58 @@
 #location will be in pymathcat
 from mathml_presentation_nosnuggle import MathMLPresentation
 from mathml_content import MathMLContent, CErrorException
-import subtree, sigure, modular
+from formula import iter_formulas, encodePresentation, encodeContent, encodeFormulas
+from reader import read_lines, read_lines_at, index_lines, iter_groups, ParagraphLRU, getUnicodeText, getCleanSentence, getDep, getDepFromLines, extractDescription, extractContext, lazyContext, lazyDescription
+from depgraph import DependencyGraph
+from stagetimer import NULL_TIMER
 from os import listdir, path
 from sys import argv
-import re
 import solr
+from uploader import BatchUploader
 
-kmcsregex = r'(__(?:PRE|CODE|SPAN|FIGURE|TABLE|DIV|MATH)_\d+__)'
 mathDir = '../mathmlandextra/math_new/'
 mathadjDir = '../mathmlandextra/math_adj/'
 featureDir = '../features/feats/'
 tagDir = '../features/tags/'
 sentDir = '../splitted/multifiles/' #'maths/sentence'
-
-def getCleanSentence(sentence):
-    ms = re.findall(kmcsregex, sentence)
-    for m in ms: 
-        sentence = sentence.replace(m, '')
-    return sentence, ms
-
-def getUnicodeText(string):
-    if type(string) is str:
-        return string.decode('utf-8')
-    else:
-        return string
-
-def getDep(filename):
+snuggleUrl = 'http://localhost:9000'
+solrUrl = 'http://localhost:9000/solr/mcd.20150203.p'
+#fields compacted by encode_file(compact=True), for a payload field type:
+#solr.DelimitedPayloadTokenFilterFactory with delimiter="|" and encoder="integer"
+featureFields = ['opaths', 'upaths', 'sisters', 'subtree_presentation', 'sigure_presentation', 'modular_presentation',
+                 'ooper', 'oarg', 'uoper', 'uarg', 'subtree_content', 'sigure_content', 'modular_content']
+termDelimiter = u'|'
+termDelimiterEscape = u'\u2223' # the payload filter splits at the first delimiter
+
+def escapeTerm(term):
     '''
-    input: file in math_adj
-    use new heuristics, no need to take the longest first
+    replace the delimiter in a path term (also needed in the query terms of compacted fields)
     '''
-    adj = {} #{mathid: [child1, child2]}
-    for ln in open(filename).readlines():
-        midparent, midchildren = ln.strip().split('\t')
-        mids = midchildren.split(' ')
-        for idx in reversed(range(len(mids))):
-            if 'xhtml' not in mids[idx]:
-                mids[idx - 1] += ' %s' % mids[idx]
-                del mids[idx]
-        adj[midparent] = mids
-    return adj
+    if isinstance(term, unicode):
+        return term.replace(termDelimiter, termDelimiterEscape)
+    if isinstance(term, str):
+        return term.replace(termDelimiter.encode('utf-8'), termDelimiterEscape.encode('utf-8'))
+    return term
 
-def extractDescription(featurepaper, tagpaper):
+def compactTerms(terms):
     '''
-    input: tags/6/0812.0981 and features/6/0812.0981
-    Paraname + kmcs-id is enough to be the key, since sentence for extraction replace XML elements with kmcs-id
-    return dictionary which its key is mathID triple and its value is description
+    input: [u'mi#x', u'mo#+', u'mi#x']
+    return each distinct term once with its frequency, in order of first occurrence: [u'mi#x|2', u'mo#+|1']
     '''
-    desc = {} #{(para, kmcsid): [desc1, desc2]}
-    for fl in listdir(tagpaper):
-        taglns = open(path.join(tagpaper, fl)).readlines()
-        fetlns = open(path.join(featurepaper, fl).replace('arff', 'txt')).readlines()
-        for idx, ln in enumerate(taglns):
-            if ln.startswith('True'):
-               fetcells = fetlns[idx].strip().split('\t')
-               description = getUnicodeText(getCleanSentence(' '.join(fetcells[1:]))[0])
-               if (fl, fetcells[0]) in desc:
-                   desc[(fl.replace('arff', 'txt'), fetcells[0])].append(description)
-               else:
-                   desc[(fl.replace('arff', 'txt'), fetcells[0])] = [description]
-    #get at least unique value, overlap will be consiered to be unique                   
-    for k in desc.iterkeys():
-        desc[k] = list(set(desc[k]))
-    return desc
-    
-def extractContext(sentencepaper):
-    '''
-    input: splitted/multifiles/6/0812.0981
-    return dictionary which its key is mathID triple and its value is context
-    '''
-    context = {}
-    for fl in listdir(sentencepaper):
-        lns = open(path.join(sentencepaper, fl)).readlines()
-        for ln in lns:
-            cleansent, matches = getCleanSentence(ln.strip())
-            for m in matches:
-                if (fl, m) in context: print 'double kmcs-id'
-                context[(fl, m)] = getUnicodeText(cleansent)
-    return context
+    counts = {}
+    distinct = []
+    for term in terms:
+        if term in counts:
+            counts[term] += 1
+        else:
+            counts[term] = 1
+            distinct.append(term)
+    return [u'%s|%d' % (getUnicodeText(escapeTerm(term)), counts[term]) if isinstance(term, basestring) else u'%d|%d' % (term, counts[term])
+            for term in distinct]
 
 def extractParagraph(parafl):
-    lns = open(parafl).readlines()
     sentences = []
-    for ln in lns:
+    for ln in read_lines(parafl):
         cleansent, matches = getCleanSentence(ln.strip())
         sentences.append(getUnicodeText(cleansent))
     return sentences
@@ -96,52 +65,15 @@ def extractParagraphs(paperpath):
         allterms[parapath] = terms
     return allterms
 
-def encodePresentation(procPres, mathml):
-    semantics, mts_string, mts_presentation = procPres.get_doc_with_orig(mathml)
-    opaths = []
-    upaths = []
-    sisters = []
-    subhash = []
-    sighash = []
-    modhash = []
-    if semantics is not None:
-        opaths, sisters = procPres.get_ordered_paths_and_sisters(semantics, False)
-        upaths = map(lambda paths: ' '.join(map(getUnicodeText, paths)), procPres.get_unordered_paths(opaths))
-        sisters = map(lambda family: ' '.join(map(getUnicodeText, family)), sisters)
-        opaths = map(lambda paths: ' '.join(map(getUnicodeText, paths)), opaths) 
-        subhash = subtree.hash_string(mts_presentation)
-        sighash = sigure.hash_string(mts_presentation)
-        modhash = modular.hash_string_generator(2 ** 32)(mts_presentation)
-    return opaths, upaths, sisters, subhash, sighash, modhash
-
-def encodeContent(procCont, mathml):
-    oopers = []
-    oargs = []
-    uopers = []
-    uargs = []
-    trees, cmathmls_str = procCont.encode_mathml_as_tree(mathml)
-    for tree in trees:
-        ooper, oarg = procCont.encode_paths(tree)
-        uoper = procCont.get_unordered_paths(ooper)
-        uarg = procCont.get_unordered_paths(oarg)
-        oopers.extend(map(getUnicodeText, ooper))
-        oargs.extend(map(getUnicodeText, oarg))
-        uopers.extend(map(getUnicodeText, uoper))
-        uargs.extend(map(getUnicodeText, uarg))
-    subhash = []
-    sighash = []
-    modhash = []
-    for cmathml_str in cmathmls_str:
-        subhash.extend(subtree.hash_string(cmathml_str))
-        sighash.extend(sigure.hash_string(cmathml_str))
-        modhash.extend(modular.hash_string_generator(2 ** 32)(cmathml_str))
-    return oopers, oargs, uopers, uargs, subhash, sighash, modhash
-
-def encode_file(filepath, solr):
-    procPres = MathMLPresentation('http://localhost:9000')
-    procCont = MathMLContent()
+def encode_file(filepath, solr, procPres=None, procCont=None, cache=None, sidecar=None, timer=None, compact=False, minhash=None, dep_depth=1):
+    procPres = procPres or MathMLPresentation(snuggleUrl)
+    procCont = procCont or MathMLContent()
+    timer = timer or NULL_TIMER
     '''
     input: 1/0705.0912.txt
+    compact: send each distinct term of the featureFields once, with its frequency in the paragraph (see compactTerms)
+    minhash: a minhash.MinHasher, to add the signatures and LSH band keys of the subtree values of the paragraph
+    dep_depth: levels of the dependency graph in context_children and description_children (see depgraph)
     For each math:
     1. get the related maths by look at createNewDep return value.
     2. get its own description
@@ -157,29 +89,37 @@ def encode_file(filepath, solr):
     tagfl = path.join(tagDir, paperpath)
     sentfl = path.join(sentDir, paperpath)
 
-    adj = getDep(mathadjfl)
-    contextDict = extractContext(sentfl)
-    descDict = extractDescription(featurefl, tagfl)
-    paragraphsInfo = extractParagraphs(paperpath)
-
-    mathlns = open(mathfl).readlines()
-    mathlist = {}
-    for ln in mathlns:
-        cells = ln.split('\t')
-        paraname = cells[1]
-        parapath = path.join(paperpath, paraname)
-        if parapath in mathlist:
-            mathlist[parapath].append(ln)
-        else:
-            mathlist[parapath] = [ln]
+    #from the sidecar (see sidecar.py) if the paper is in it
+    paralist = sidecar.paragraphs(paperpath) if sidecar is not None else None
+    deps = None
+    if paralist is None:
+        contextDicts = lazyContext(sentfl, timer)
+        descDicts = lazyDescription(featurefl, tagfl, timer)
+        paralist = listdir(sentfl)
+    else:
+        contextDicts = sidecar.contexts(paperpath)
+        descDicts = sidecar.descriptions(paperpath)
+        deps = sidecar.dependencies(paperpath, dep_depth)
+    #math_new and math_adj are read one paragraph at a time, context and descriptions on demand
+    if deps is None:
+        with timer.stage('read'):
+            adjIndex = index_lines(mathadjfl, lambda ln: ln.split('#', 1)[0])
+        adjacency = ParagraphLRU(timer.timed('dep', lambda paraname: getDepFromLines(read_lines_at(mathadjfl, adjIndex.get(paraname)))))
+        deps = DependencyGraph(adjacency, contextDicts, descDicts, dep_depth)
+    paras = dict((para.replace('txt', 'xhtml'), para) for para in paralist)
 
     #Index paragrap which have mathml
-    for parapath, lns in mathlist.iteritems():
+    for paraname, lns in timer.iterate('read', iter_groups(mathfl, lambda ln: ln.split('\t')[1])):
+        parapath = path.join(paperpath, paraname)
+        with timer.stage('paragraph'):
+            body = extractParagraph(path.join(sentfl, paras.pop(paraname)))
         doc = {"gpid": parapath, 
-               "body": paragraphsInfo[parapath],
+               "body": body,
         }
-        del paragraphsInfo[parapath]
-        for ln in lns:
+        with timer.stage('parse'):
+            formulas = list(iter_formulas(procPres, lns, cache=cache))
+        encodings = iter(encodeFormulas(procPres, procCont, [(formula, presentation_doc) for ln, formula, presentation_doc, encoding in formulas if encoding is None], timer))
+        for ln, formula, presentation_doc, encoding in formulas:
             cells = ln.split('\t')
             paraname = cells[1]
             parapath = path.join(paperpath, paraname)
@@ -190,23 +130,23 @@ def encode_file(filepath, solr):
             mathml = '\t'.join(cells[3:])
             
             #encode mathml
-            opaths, upaths, sisters, psubhash, psighash, pmodhash = encodePresentation(procPres, mathml)
-            oopers, oargs, uopers, uargs, csubhash, csighash, cmodhash = encodeContent(procCont, mathml)
+            cached = encoding is not None
+            if encoding is None:
+                encoding = next(encodings)
+                if cache is not None: cache.put(mathml, encoding)
+            (opaths, upaths, sisters, psubhash, psighash, pmodhash), (oopers, oargs, uopers, uargs, csubhash, csighash, cmodhash) = encoding
+            if timer.enabled:
+                timer.count('formulas')
+                if cached: timer.count('cache_hits')
+                timer.count('paths', sum(map(len, [opaths, upaths, sisters, oopers, oargs, uopers, uargs])))
+                timer.count('hash_values', sum(map(len, [psubhash, psighash, pmodhash, csubhash, csighash, cmodhash])))
 
             #encode context and description
-            textdictid = tuple([paraname.replace('xhtml', 'txt'), kmcsid])
-            context = contextDict[textdictid] if textdictid in contextDict else '' # a string
-            descs = descDict[textdictid] if textdictid in descDict else [] # a list of string
+            context, descs = deps.texts(mid)
+            context = context or '' # a string
 
             #encode textual information from children
-            children = adj[mid] if mid in adj else []
-            context_children = [] # a list of string
-            desc_children = []
-            for child in children:
-                paraname_child, kmcsid_child, latexmlid_child = child.split('#')
-                textdictchildid = tuple([paraname_child.replace('xhtml', 'txt'), kmcsid_child])
-                if textdictchildid in contextDict: context_children.append(contextDict[textdictchildid])
-                if textdictchildid in descDict: desc_children.extend(descDict[textdictchildid])
+            context_children, desc_children = deps.children(mid) # lists of string
 
             if context.strip() != '':
                 doc.setdefault('context_en', []).append(context)
@@ -233,18 +173,31 @@ def encode_file(filepath, solr):
                 doc.setdefault('subtree_content', []).extend(csubhash)
                 doc.setdefault('sigure_content', []).extend(csighash)
                 doc.setdefault('modular_content', []).extend(cmodhash)
-        solr.add_many(list([doc]))
+        if minhash is not None:
+            with timer.stage('minhash'):
+                minhash.add_fields(doc)
+        if compact:
+            for field in featureFields:
+                if field in doc: doc[field] = compactTerms(doc[field])
+        with timer.stage('upload'):
+            solr.add_many(list([doc]))
+        timer.count('docs')
 
     #upload paragraphs without math
-    for parapath, contents in paragraphsInfo.iteritems():
-        solr.add_many(list([dict(gpid=parapath, body=contents)]))
+    for paraname, para in paras.iteritems():
+        with timer.stage('paragraph'):
+            body = extractParagraph(path.join(sentfl, para))
+        with timer.stage('upload'):
+            solr.add_many(list([dict(gpid=path.join(paperpath, paraname), body=body)]))
+        timer.count('docs')
             
 if __name__ == '__main__':
-    s = solr.SolrConnection('http://localhost:9000/solr/mcd.20150203.p')
+    s = BatchUploader(solr.SolrConnection(solrUrl))
     inp = argv[1]
     filepath = path.relpath(inp, '.')
     try:
         encode_file(filepath, s)
+        s.close()
     except:
         print filepath + ' error'
 
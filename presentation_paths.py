@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Presentation path encoder shared by mathml_presentation and
+mathml_presentation_nosnuggle.
+
+    opaths, upaths, sisters = PresentationPaths('snuggle').encode(root, query)
+
+One walk of the presentation tree gives the ordered paths and sisters of
+MathMLPresentation.get_ordered_paths_and_sisters and the unordered paths
+get_unordered_paths computes from them. A node's paths are its own name
+followed by the paths of its children behind their position (1#mi#x);
+every path is joined once per level from the path of the child, and its
+unordered form (#mi#x) alongside it, so the position regex only runs on the
+node names, never on whole paths.
+
+The mode selects the output of the two MathMLPresentation classes:
+'snuggle' removes the duplicate unordered paths and sisters (in a node, then
+among the nodes, first occurrence kept), 'nosnuggle' keeps them all.
+'''
+import re
+
+class PathFrame(object):
+    '''
+    an element being walked by PresentationPaths.encode
+    '''
+    __slots__ = ('wrapper', 'wrapped_wrapper', 'curpath', 'curlist', 'ucurlist', 'cursisters', 'i', 'children')
+
+class PresentationPaths(object):
+    SEPARATOR = '#'
+    modes = ('snuggle', 'nosnuggle')
+    re_node_text = re.compile(r'\s')
+    re_position = re.compile(r'\d+(#)')
+
+    def __init__(self, mode='nosnuggle'):
+        if mode not in self.modes:
+            raise ValueError('unknown presentation path mode: %s' % mode)
+        self.mode = mode
+
+    def __uniqList(self, lst):
+        #same as list(OrderedDict.fromkeys(lst)), without the pure python OrderedDict
+        seen = set()
+        return [x for x in lst if not (x in seen or seen.add(x))]
+
+    def __uniqListOfList(self, listoflist):
+        seen = set()
+        return [lst for lst, key in ((lst, tuple(lst)) for lst in listoflist) if not (key in seen or seen.add(key))]
+
+    def __unordered(self, path, unordered_names):
+        upath = unordered_names.get(path)
+        if upath is None:
+            upath = unordered_names[path] = self.re_position.sub(r'\1', path) if self.SEPARATOR in path else path
+        return upath
+
+    def __enter(self, parent, was_wrapper, unordered_names):
+        while parent.tag == 'mstyle' and len(parent) == 1:
+            parent = parent[0]
+        name = parent.tag
+        text = parent.text and self.re_node_text.sub('_', parent.text.strip())
+        frame = PathFrame()
+        frame.wrapper = (name == 'mrow' or name == 'mfenced' or name == 'math') and len(parent) == 1
+
+        frame.wrapped_wrapper = frame.wrapper and was_wrapper
+        if (name == 'mi' and text == u'\u25EF') or (name == 'mo' and text == u'\u25FB'):
+            frame.curpath = '*'
+            frame.curlist = [frame.curpath]
+        elif name == 'mrow' or name == 'mfenced' or name == 'math':
+            frame.curpath = name
+            frame.curlist = []
+        else:
+            frame.curpath = name
+            text = parent.text and parent.text.strip()
+            if len(parent) == 0 and text:
+                frame.curpath += self.SEPARATOR + text
+            frame.curlist = [] if frame.wrapped_wrapper else [frame.curpath]
+        if unordered_names is not None:
+            frame.ucurlist = [self.__unordered(path, unordered_names) for path in frame.curlist]
+        frame.cursisters = []
+        frame.i = 0
+        frame.children = (child for child in parent if not(child.tag == 'mo' and child.text and child.text.strip() == u'\u2062'))
+        return frame
+
+    def encode(self, root, query, unordered=True):
+        '''
+        return opaths, upaths and sisters of root (upaths is None if not unordered).
+        query: only the paths of root itself, not those of every node
+        '''
+        opaths = []
+        upaths = [] if unordered else None
+        sisters = []
+        unordered_names = {} if unordered else None
+        #explicit stack of PathFrame; the path lists of the nodes are listed in preorder, and
+        #a child's paths are added to its parent's list when the child is done
+        stack = [self.__enter(root, False, unordered_names)]
+        opaths.append(stack[0].curlist)
+        if unordered: upaths.append(stack[0].ucurlist)
+        while stack:
+            frame = stack[-1]
+            child = next(frame.children, None)
+            if child is not None:
+                child_frame = self.__enter(child, frame.wrapper, unordered_names)
+                if not query:
+                    opaths.append(child_frame.curlist)
+                    if unordered: upaths.append(child_frame.ucurlist)
+                stack.append(child_frame)
+                continue
+            stack.pop()
+            if len(frame.cursisters) > 0: sisters.append(frame.cursisters)
+            if not stack:
+                break
+            parent = stack[-1]
+            subname = frame.curpath
+            if subname and subname not in ['', 'mrow', 'mfenced', 'math']:
+                parent.cursisters.append(subname)
+            parent.i += 1
+            if parent.wrapped_wrapper:
+                parent.curlist.extend(frame.curlist)
+                if unordered: parent.ucurlist.extend(frame.ucurlist)
+            else:
+                prefix = str(parent.i) + self.SEPARATOR
+                parent.curlist.extend([prefix + path for path in frame.curlist])
+                if unordered: parent.ucurlist.extend([self.SEPARATOR + path for path in frame.ucurlist])
+        #the leading mrow or math of a path list is dropped, then the empty lists
+        for i, paths in enumerate(opaths):
+            if len(paths) > 0 and (paths[0] == 'mrow' or paths[0] == 'math'):
+                opaths[i] = paths[1:]
+                if unordered: upaths[i] = upaths[i][1:]
+        if unordered:
+            upaths = [upaths[i] for i, paths in enumerate(opaths) if len(paths) > 0]
+        opaths = [paths for paths in opaths if len(paths) > 0]
+        if self.mode == 'snuggle':
+            if unordered: upaths = self.__uniqListOfList(map(self.__uniqList, upaths))
+            sisters = self.__uniqListOfList(map(self.__uniqList, sisters))
+        return opaths, upaths, sisters
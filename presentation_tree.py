@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Presentation tree normalization shared by mathml_presentation and
+mathml_presentation_nosnuggle.
+
+    doc = normalize(formula.doc, ('script', 'annotation-xml', 'annotation'))
+    root = get_semantics_child(doc)
+
+normalize works in place, in a single walk, on the tree the content encoder
+also reads (see formula.Formula), instead of serializing and parsing it
+again.
+'''
+from lxml import etree
+
+# attributes objectify.deannotate removed
+ANNOTATION_ATTRS = frozenset(['{http://codespeak.net/lxml/objectify/pytype}pytype', '{http://www.w3.org/2001/XMLSchema-instance}type'])
+
+def normalize(root, drop):
+    '''
+    normalize the tree under root in place, in a single walk: elements and attributes get their local
+    names (no namespace), the objectify/xsi type annotations are dropped, and the descendants whose
+    name is in drop are removed with their tail.
+    return root
+    '''
+    #the elements are listed first: lxml looks up the ancestors of every element proxy it frees
+    elems = list(root.iter(etree.Element))
+    dropped = []
+    for elem in elems:
+        tag = elem.tag
+        if tag[0] == '{':
+            tag = elem.tag = tag[tag.index('}') + 1:]
+        if tag in drop and elem is not root:
+            dropped.append(elem)
+        attrib = elem.attrib
+        for key in attrib.keys():
+            if key[0] == '{':
+                items = attrib.items()
+                attrib.clear()
+                for key, value in items:
+                    if key not in ANNOTATION_ATTRS: attrib[key[key.find('}') + 1:]] = value
+                break
+    for elem in dropped:
+        elem.getparent().remove(elem)
+    etree.cleanup_namespaces(root)
+    return root
+
+def get_semantics_child(doc):
+    '''
+    return the first child of the innermost semantics under doc (the presentation root), or None
+    '''
+    semantics = doc.find('semantics')
+    if semantics is None:
+        return None
+    inner = semantics.find('semantics')
+    while inner is not None:
+        semantics, inner = inner, inner.find('semantics')
+    return semantics[0] if len(semantics) > 0 else None
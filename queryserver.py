@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Long-lived query encoding service.
+
+    python queryserver.py -e paragraph --port 8984
+    python queryserver.py -e paragraph --socket /tmp/mcat-query.sock
+
+POST /encode with the query mathml as the body (or as the form field q,
+like the snuggle servlet) returns the query terms as JSON, in the fields of
+the indexed documents: opaths, upaths, sisters, ooper, oarg, uoper, uarg
+and the subtree, sigure and modular hash lists of the presentation and of
+the content. Presentation paths are built in query mode, and qvar elements
+are wildcards (see sigure.hash_qvar). With --compact, the delimiter is
+escaped in the path terms as in the compacted index (paragraph_encode.escapeTerm).
+With --minhash, the LSH band keys of the subtree values are added as
+lsh_presentation and lsh_content (use the spec of indexer.py --minhash).
+
+The encoder module, its MathMLPresentation (with the compiled XSLT) and
+MathMLContent are loaded once; repeated queries are answered from a
+cache.FormulaCache held in memory. GET /stats returns the number of queries,
+the cache counters and the p50/p99/max latency (milliseconds, measured
+around the encoding) of the last --window queries.
+
+Requests are served one at a time: the processors are not shared between
+threads. Run several instances for concurrency.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from collections import deque
+
+from cache import FormulaCache
+from formula import Formula
+from indexer import encoders
+
+class LatencyStats:
+    '''
+    Latencies of the last window requests, in seconds.
+    '''
+    def __init__(self, window=10000):
+        self.count = 0
+        self.__latencies = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.__latencies.append(seconds)
+
+    def percentile(self, p):
+        if not self.__latencies:
+            return 0.0
+        latencies = sorted(self.__latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'window': len(self.__latencies),
+            'p50_ms': self.percentile(50) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': max(self.__latencies) * 1000 if self.__latencies else 0.0,
+        }
+
+class QueryEncoder:
+    '''
+    Encode query mathml with the warm processors of an encoder module
+    (paragraph_encode or mathmldescription_encode).
+    '''
+    def __init__(self, encoder='paragraph', max_entries=10000, window=10000, compact=False, minhash=None):
+        self.module = __import__(encoders[encoder])
+        self.compact = compact
+        self.minhash = minhash
+        self.procPres = self.module.MathMLPresentation(self.module.snuggleUrl)
+        self.procCont = self.module.MathMLContent()
+        self.cache = FormulaCache(namespace='query:%s' % self.module.MathMLPresentation.__module__, max_entries=max_entries)
+        self.latency = LatencyStats(window)
+
+    def __encode(self, mathml):
+        formula = Formula(mathml)
+        presentation_doc = self.procPres.get_doc_from_formula(formula)
+        opaths, upaths, sisters, psubhash, psighash, pmodhash = self.module.encodePresentation(self.procPres, presentation_doc, query=True)
+        oopers, oargs, uopers, uargs, csubhash, csighash, cmodhash = self.module.encodeContent(self.procCont, formula)
+        if self.compact:
+            opaths, upaths, sisters, oopers, oargs, uopers, uargs = [map(self.module.escapeTerm, terms) for terms in [opaths, upaths, sisters, oopers, oargs, uopers, uargs]]
+        terms = {
+            'opaths': opaths,
+            'upaths': upaths,
+            'sisters': sisters,
+            'subtree_presentation': psubhash,
+            'sigure_presentation': psighash,
+            'modular_presentation': pmodhash,
+            'ooper': oopers,
+            'oarg': oargs,
+            'uoper': uopers,
+            'uarg': uargs,
+            'subtree_content': csubhash,
+            'sigure_content': csighash,
+            'modular_content': cmodhash,
+        }
+        if self.minhash is not None:
+            for kind, subhash in [('presentation', psubhash), ('content', csubhash)]:
+                terms['lsh_' + kind] = self.minhash.band_keys(self.minhash.signature(subhash))
+        return terms
+
+    def encode(self, mathml):
+        '''
+        return the query terms of mathml (utf-8 or unicode) as a dictionary of field: list
+        '''
+        if isinstance(mathml, unicode):
+            mathml = mathml.encode('utf-8')
+        start = time.time()
+        result = self.cache.get(mathml)
+        if result is None:
+            result = self.__encode(mathml)
+            self.cache.put(mathml, result)
+        self.latency.add(time.time() - start)
+        return result
+
+    def stats(self):
+        stats = self.latency.stats()
+        stats['cache'] = self.cache.stats()
+        return stats
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive: clients reuse the connection
+    wbufsize = -1 # the response goes out in one write: small writes wait on delayed acks
+
+    def __reply(self, code, value):
+        body = json.dumps(value)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] == '/stats':
+            self.__reply(200, self.server.encoder.stats())
+        else:
+            self.__reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        if self.path.split('?', 1)[0] != '/encode':
+            self.__reply(404, {'error': 'not found'})
+            return
+        if self.headers.gettype() == 'application/x-www-form-urlencoded':
+            body = urlparse.parse_qs(body).get('q', [''])[0]
+        try:
+            self.__reply(200, self.server.encoder.encode(body))
+        except Exception as e:
+            self.__reply(400, {'error': str(e)})
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class QueryServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, address, encoder, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+        self.encoder = encoder
+        self.verbose = verbose
+
+class UnixQueryServer(SocketServer.UnixStreamServer):
+    def __init__(self, socketpath, encoder, verbose=False):
+        if os.path.exists(socketpath):
+            os.remove(socketpath)
+        SocketServer.UnixStreamServer.__init__(self, socketpath, QueryHandler)
+        self.encoder = encoder
+        self.verbose = verbose
+
+    def get_request(self):
+        request, client_address = SocketServer.UnixStreamServer.get_request(self)
+        return request, ('unix', 0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve query encodings over HTTP.')
+    parser.add_argument('-e', '--encoder', choices=sorted(encoders), default='paragraph')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8984)
+    parser.add_argument('--socket', help='listen on this unix socket instead of host:port')
+    parser.add_argument('--cache-entries', type=int, default=10000, help='queries kept in the cache')
+    parser.add_argument('--window', type=int, default=10000, help='latest queries the latency percentiles are computed on')
+    parser.add_argument('--compact', action='store_true', help='escape the path terms for an index built with indexer.py --compact (paragraph encoder)')
+    parser.add_argument('--minhash', metavar='PERMxBANDS', help='add the LSH band keys of the subtree values, with the signature size of the index (indexer.py --minhash)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request to stderr')
+    args = parser.parse_args()
+    if args.compact and args.encoder != 'paragraph':
+        parser.error('--compact applies to the paragraph encoder only')
+    minhash = None
+    if args.minhash:
+        from minhash import MinHasher
+        try:
+            minhash = MinHasher.parse(args.minhash)
+        except ValueError as e:
+            parser.error(str(e))
+    encoder = QueryEncoder(args.encoder, args.cache_entries, args.window, args.compact, minhash)
+    if args.socket:
+        server = UnixQueryServer(args.socket, encoder, args.verbose)
+    else:
+        server = QueryServer((args.host, args.port), encoder, args.verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.stderr.write('%s\n' % json.dumps(encoder.stats()))
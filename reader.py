@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+from collections import OrderedDict
+from os import listdir, path
+import re
+from stagetimer import NULL_TIMER
+
+kmcsregex = r'(__(?:PRE|CODE|SPAN|FIGURE|TABLE|DIV|MATH)_\d+__)'
+
+def read_lines(filename):
+    '''
+    yield the lines of filename one at a time
+    '''
+    with open(filename, 'rb') as f:
+        for ln in f:
+            yield ln
+
+def index_lines(filename, key):
+    '''
+    read filename once, keeping only the offsets of its lines
+    return {key(line): [offset1, offset2]}, in order of first appearance
+    '''
+    index = OrderedDict()
+    offset = 0
+    for ln in read_lines(filename):
+        index.setdefault(key(ln), []).append(offset)
+        offset += len(ln)
+    return index
+
+def read_lines_at(filename, offsets):
+    '''
+    return the lines of filename starting at offsets (see index_lines)
+    '''
+    if not offsets:
+        return []
+    lns = []
+    with open(filename, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            lns.append(f.readline())
+    return lns
+
+def iter_groups(filename, key):
+    '''
+    yield (key, lines) for the lines of filename grouped by key(line), in
+    order of first appearance. Only one group is in memory at a time: the
+    lines are located by a first pass that keeps their offsets.
+    '''
+    index = index_lines(filename, key)
+    for k, offsets in index.iteritems():
+        yield k, read_lines_at(filename, offsets)
+
+class ParagraphLRU:
+    '''
+    The per-paragraph dictionaries (context, descriptions) of a paper,
+    loaded on demand with load(name) and keeping the max_entries most
+    recently used. Formulas mostly refer to their own or nearby paragraphs,
+    so a few entries are enough; an evicted paragraph is loaded again.
+    '''
+    def __init__(self, load, max_entries=16):
+        self.load = load
+        self.max_entries = max_entries
+        self.__entries = OrderedDict()
+
+    def __getitem__(self, name):
+        value = self.__entries.pop(name, None)
+        if value is None:
+            value = self.load(name)
+            if len(self.__entries) >= self.max_entries:
+                self.__entries.popitem(last=False)
+        self.__entries[name] = value
+        return value
+
+# the math_adj, sentence, tag and feature files of a paper, shared by paragraph_encode and mathmldescription_encode
+
+def getUnicodeText(string):
+    if type(string) is str:
+        return string.decode('utf-8')
+    else:
+        return string
+
+def getCleanSentence(sentence):
+    ms = re.findall(kmcsregex, sentence)
+    for m in ms: 
+        sentence = sentence.replace(m, '')
+    return sentence, ms
+
+re_adj_split = re.compile(r' (?=[^ ]*xhtml)')
+
+def getDep(filename):
+    '''
+    input: file in math_adj
+    use new heuristics, no need to take the longest first
+    '''
+    return getDepFromLines(read_lines(filename))
+
+def getDepFromLines(lns):
+    '''
+    input: lines of math_adj (see getDep)
+    '''
+    adj = {} #{mathid: [child1, child2]}
+    for ln in lns:
+        midparent, midchildren = ln.strip().split('\t')
+        #a piece without xhtml belongs to the mathid before it, those before the first mathid to the last one
+        mids = re_adj_split.split(midchildren)
+        if 'xhtml' not in mids[0]:
+            leading = mids.pop(0)
+            if mids: mids[-1] += ' ' + leading
+        adj[midparent] = mids
+    return adj
+
+def extractDescription(featurepaper, tagpaper, fls=None):
+    '''
+    input: tags/6/0812.0981 and features/6/0812.0981, and optionally the tag files to read (default: all)
+    Paraname + kmcs-id is enough to be the key, since sentence for extraction replace XML elements with kmcs-id
+    return dictionary which its key is mathID triple and its value is description
+    '''
+    desc = {} #{(para, kmcsid): [desc1, desc2]}
+    for fl in (listdir(tagpaper) if fls is None else fls):
+        tagfl = path.join(tagpaper, fl)
+        fetfl = path.join(featurepaper, fl).replace('arff', 'txt')
+        fetlns = read_lines(fetfl)
+        for idx, ln in enumerate(read_lines(tagfl)):
+            fetln = next(fetlns, None)
+            if ln.startswith('True'):
+               if fetln is None:
+                   raise IndexError('%s has no line %d, tagged in %s' % (fetfl, idx + 1, tagfl))
+               fetcells = fetln.strip().split('\t')
+               description = getUnicodeText(getCleanSentence(' '.join(fetcells[1:]))[0])
+               if (fl, fetcells[0]) in desc:
+                   desc[(fl.replace('arff', 'txt'), fetcells[0])].append(description)
+               else:
+                   desc[(fl.replace('arff', 'txt'), fetcells[0])] = [description]
+    #get at least unique value, overlap will be consiered to be unique                   
+    for k in desc.iterkeys():
+        desc[k] = list(set(desc[k]))
+    return desc
+
+def extractContext(sentencepaper, fls=None):
+    '''
+    input: splitted/multifiles/6/0812.0981, and optionally the paragraph files to read (default: all)
+    return dictionary which its key is mathID triple and its value is context
+    '''
+    context = {}
+    for fl in (listdir(sentencepaper) if fls is None else fls):
+        for ln in read_lines(path.join(sentencepaper, fl)):
+            cleansent, matches = getCleanSentence(ln.strip())
+            for m in matches:
+                if (fl, m) in context: print 'double kmcs-id'
+                context[(fl, m)] = getUnicodeText(cleansent)
+    return context
+
+def lazyContext(sentencepaper, timer=NULL_TIMER):
+    '''
+    input: splitted/multifiles/6/0812.0981
+    return contexts where contexts[fl] is extractContext of the paragraph file fl only, loaded on demand
+    '''
+    fls = set(listdir(sentencepaper))
+    return ParagraphLRU(timer.timed('context', lambda fl: extractContext(sentencepaper, [fl] if fl in fls else [])))
+
+def lazyDescription(featurepaper, tagpaper, timer=NULL_TIMER):
+    '''
+    input: tags/6/0812.0981 and features/6/0812.0981
+    return descs where descs[fl] is extractDescription of the paragraph file fl only, loaded on demand
+    '''
+    fls = {}
+    for fl in listdir(tagpaper):
+        fls.setdefault(fl.replace('arff', 'txt'), []).append(fl)
+    return ParagraphLRU(timer.timed('description', lambda fl: extractDescription(featurepaper, tagpaper, fls.get(fl, []))))
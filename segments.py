@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Offline document sink: gzip-compressed JSONL segment files, loaded into
+Solr afterwards by bulkload.py.
+
+    writer = SegmentWriter('export', 'paragraph-20150203T120000', '4242')
+    encode_file(filepath, writer)
+    writer.close()
+
+SegmentWriter has the interface of uploader.BatchUploader (add, add_many,
+delete_query, flush, close), so the encoders and the indexer write to it
+instead of a live Solr (indexer.py --export DIR).
+
+Every line of a segment is one command of the Solr JSON update format,
+{"add": {"doc": {...}}} or {"delete": {"query": "..."}}, in the order the
+writer received them. Segments are named <run>.<writer>.<sequence>.jsonl.gz;
+a segment is written as <name>.tmp and renamed when complete, so a reader
+never sees a partial segment.
+'''
+import gzip
+import json
+import os
+import re
+from os import path
+
+SUFFIX = '.jsonl.gz'
+re_segment = re.compile(r'^(?P<run>.+)\.(?P<writer>[^.]+)\.(?P<sequence>\d+)\.jsonl\.gz$')
+
+def segment_name(run, writer, sequence):
+    return '%s.%s.%05d%s' % (run, writer, sequence, SUFFIX)
+
+def list_segments(directory):
+    '''
+    return the complete segments of directory as (run, writer, segment paths in
+    sequence order), sorted by run
+    '''
+    groups = {}
+    for fl in os.listdir(directory):
+        m = re_segment.match(fl)
+        if m:
+            groups.setdefault((m.group('run'), m.group('writer')), []).append((int(m.group('sequence')), path.join(directory, fl)))
+    return [(run, writer, [flpath for sequence, flpath in sorted(groups[run, writer])]) for run, writer in sorted(groups)]
+
+class SegmentWriter:
+    '''
+    Write documents and delete queries to the segments of one writer (a name
+    without dots, e.g. the worker pid) of a run (e.g. encoder and start time).
+
+    A segment is completed after max_docs commands or max_bytes
+    (uncompressed) bytes, on flush and on close. flush completes the current
+    segment so that the documents added so far are in a complete segment; the
+    indexer calls it per paper in incremental mode only.
+    '''
+    def __init__(self, directory, run, writer, max_docs=100000, max_bytes=256 * 1024 * 1024, compresslevel=6):
+        if not path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not path.isdir(directory): raise
+        self.directory = directory
+        self.run = run
+        self.writer = writer
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self.docs_added = 0
+        self.bytes_added = 0
+        self.segments = []
+        self.closed = False
+        self.__sequence = 0
+        self.__file = None
+        self.__docs = 0
+        self.__bytes = 0
+
+    def __segment_path(self):
+        return path.join(self.directory, segment_name(self.run, self.writer, self.__sequence))
+
+    def __write(self, command):
+        if self.__file is None:
+            self.__file = gzip.open(self.__segment_path() + '.tmp', 'wb', self.compresslevel)
+        line = json.dumps(command) + '\n'
+        self.__file.write(line)
+        self.__docs += 1
+        self.__bytes += len(line)
+        if self.__docs >= self.max_docs or self.__bytes >= self.max_bytes:
+            self.__complete()
+        return len(line)
+
+    def __complete(self):
+        if self.__file is None:
+            return
+        self.__file.close()
+        self.__file = None
+        segmentpath = self.__segment_path()
+        os.rename(segmentpath + '.tmp', segmentpath)
+        self.segments.append(segmentpath)
+        self.__sequence += 1
+        self.__docs = 0
+        self.__bytes = 0
+
+    def add(self, doc):
+        self.bytes_added += self.__write({'add': {'doc': doc}})
+        self.docs_added += 1
+
+    def add_many(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    def delete_query(self, query):
+        '''
+        delete the documents matching query, after the documents added so far
+        '''
+        self.__write({'delete': {'query': query}})
+
+    def flush(self):
+        self.__complete()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.__complete()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Corpus-wide, read-only index of the texts the encoders look up per formula:
+the context (splitted/multifiles) and the descriptions (features/feats and
+features/tags) keyed by (paper, paragraph file, kmcs-id), and the paragraph
+files of each paper.
+
+Build it once, offline, from the same directories as the encoder:
+
+    python sidecar.py -e paragraph texts.sidecar papers.txt
+
+and pass it to the indexer (--sidecar texts.sidecar): encode_file then
+looks the texts up in the memory-mapped file instead of listing and reading
+the tag, feature and sentence directories of every paper.
+
+With --dep-depth N it also stores the context_children and
+description_children of every formula, resolved through the math_adj
+dependency graph up to N levels (see depgraph); the encoders use them when
+run with the same depth (indexer.py --dep-depth, 1 by default) and read
+math_adj otherwise.
+
+File layout (little endian): a header (magic, number of slots, offset of
+the records), an open-addressing table of (key hash, record offset) slots,
+at most half full and probed linearly, and the records (key length, value
+length, key, JSON value).
+'''
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from collections import defaultdict
+
+from depgraph import DependencyGraph
+
+MAGIC = 'MCSIDE01'
+HEADER = struct.Struct('<8sQQ')
+SLOT = struct.Struct('<QQ')
+RECORD = struct.Struct('<II')
+DEPENDENCIES = 'dependencies' # make_key(paperpath, DEPENDENCIES): the depth of the stored children
+
+def key_hash(key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+def make_key(paperpath, fl='', kmcsid=''):
+    '''
+    input: 1/0704.0097, p1.txt and __MATH_3__; the key of the paragraph list of a paper is (paperpath, '', '')
+    '''
+    return '\0'.join([paperpath, fl, kmcsid])
+
+class SidecarWriter:
+    '''
+    Write a sidecar file: add(key, value) for distinct keys, then close().
+    Records are spooled to a temporary file; only the hashes and offsets are
+    kept in memory, packed as the slots of the file (unsigned 64-bit,
+    whatever the size of a C long on the platform).
+    '''
+    def __init__(self, sidecarpath):
+        self.path = sidecarpath
+        self.__records = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(sidecarpath)))
+        self.__entries = bytearray() # SLOT of every record: key hash and offset among the records
+        self.__count = 0
+        self.__size = 0
+
+    def add(self, key, value):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        value = json.dumps(value)
+        self.__records.write(RECORD.pack(len(key), len(value)))
+        self.__records.write(key)
+        self.__records.write(value)
+        self.__entries += SLOT.pack(key_hash(key), self.__size)
+        self.__count += 1
+        self.__size += RECORD.size + len(key) + len(value)
+
+    def close(self):
+        nslots = 1
+        while nslots < 2 * self.__count:
+            nslots *= 2
+        data_offset = HEADER.size + nslots * SLOT.size
+        table = [None] * nslots
+        for i in range(self.__count):
+            h, offset = SLOT.unpack_from(self.__entries, i * SLOT.size)
+            slot = h % nslots
+            while table[slot] is not None:
+                slot = (slot + 1) % nslots
+            table[slot] = (h, data_offset + offset)
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, nslots, data_offset))
+            for entry in table:
+                f.write(SLOT.pack(*entry) if entry is not None else SLOT.pack(0, 0))
+            self.__records.seek(0)
+            for block in iter(lambda: self.__records.read(1 << 20), ''):
+                f.write(block)
+        self.__records.close()
+        os.rename(tmppath, self.path)
+
+class Sidecar:
+    '''
+    Read-only view of a sidecar file, memory-mapped so that the workers
+    share it through the page cache.
+    '''
+    def __init__(self, sidecarpath):
+        with open(sidecarpath, 'rb') as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nslots, self.data_offset = HEADER.unpack_from(self.__map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a sidecar file' % sidecarpath)
+        self.__last = (None, None)
+
+    def get(self, key, default=None):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if self.__last[0] == key:
+            return self.__last[1]
+        h = key_hash(key)
+        slot = h % self.nslots
+        value = default
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.__map, HEADER.size + slot * SLOT.size)
+            if offset == 0:
+                break
+            if slot_hash == h:
+                keylen, valuelen = RECORD.unpack_from(self.__map, offset)
+                start = offset + RECORD.size
+                if self.__map[start:start + keylen] == key:
+                    value = json.loads(self.__map[start + keylen:start + keylen + valuelen])
+                    break
+            slot = (slot + 1) % self.nslots
+        self.__last = (key, value)
+        return value
+
+    def paragraphs(self, paperpath):
+        '''
+        return the paragraph files of the paper (listdir of splitted/multifiles/paperpath), or None
+        '''
+        return self.get(make_key(paperpath))
+
+    def contexts(self, paperpath):
+        return SidecarTexts(self, paperpath, 'context')
+
+    def descriptions(self, paperpath):
+        return SidecarTexts(self, paperpath, 'descriptions')
+
+    def dependencies(self, paperpath, depth=1):
+        '''
+        return the depgraph.DependencyGraph of the paper if its children were stored with depth, or None
+        '''
+        if self.get(make_key(paperpath, DEPENDENCIES)) != depth:
+            return None
+        return SidecarDependencies(self, paperpath, depth)
+
+    def close(self):
+        self.__map.close()
+
+class SidecarTexts:
+    '''
+    The contexts or descriptions of a paper, with the interface of the
+    encoders' per-paragraph dictionaries: texts[fl][(fl, kmcsid)]
+    '''
+    def __init__(self, sidecar, paperpath, field):
+        self.sidecar = sidecar
+        self.paperpath = paperpath
+        self.field = field
+
+    def __getitem__(self, fl):
+        return SidecarParagraph(self, fl)
+
+class SidecarParagraph:
+    def __init__(self, texts, fl):
+        self.texts = texts
+
+    def __lookup(self, textdictid):
+        fl, kmcsid = textdictid
+        value = self.texts.sidecar.get(make_key(self.texts.paperpath, fl, kmcsid))
+        return value.get(self.texts.field) if value is not None else None
+
+    def __contains__(self, textdictid):
+        return self.__lookup(textdictid) is not None
+
+    def __getitem__(self, textdictid):
+        value = self.__lookup(textdictid)
+        if value is None:
+            raise KeyError(textdictid)
+        return value
+
+class SidecarDependencies(DependencyGraph):
+    '''
+    The dependency graph of a paper, with the children of the formulas
+    looked up in the sidecar (see add_paper)
+    '''
+    def __init__(self, sidecar, paperpath, depth):
+        DependencyGraph.__init__(self, None, sidecar.contexts(paperpath), sidecar.descriptions(paperpath), depth)
+        self.sidecar = sidecar
+        self.paperpath = paperpath
+
+    def children(self, mid):
+        value = self.sidecar.get(make_key(self.paperpath, mid))
+        if value is None:
+            return [], []
+        return value['context_children'], value['description_children']
+
+def add_paper(writer, module, filepath, dep_depth=None):
+    '''
+    input: encoder module (paragraph_encode or mathmldescription_encode) and 1/0704.0097.txt
+    add the paragraph list, contexts and descriptions of the paper to writer, and
+    the children of its formulas up to dep_depth levels if given
+    '''
+    paperpath = filepath[:filepath.rindex('.')]
+    sentfl = os.path.join(module.sentDir, paperpath)
+    texts = {}
+    for textdictid, context in module.extractContext(sentfl).iteritems():
+        texts.setdefault(textdictid, {})['context'] = context
+    for textdictid, descs in module.extractDescription(os.path.join(module.featureDir, paperpath), os.path.join(module.tagDir, paperpath)).iteritems():
+        texts.setdefault(textdictid, {})['descriptions'] = descs
+    writer.add(make_key(paperpath), os.listdir(sentfl))
+    for (fl, kmcsid), value in texts.iteritems():
+        writer.add(make_key(paperpath, fl, kmcsid), value)
+    if dep_depth is None:
+        return
+    adj = module.getDep(os.path.join(module.mathadjDir, filepath))
+    adjacency = defaultdict(dict)
+    for mid, children in adj.iteritems():
+        adjacency[mid.split('#', 1)[0]][mid] = children
+    contexts = defaultdict(dict)
+    descriptions = defaultdict(dict)
+    for textdictid, value in texts.iteritems():
+        if 'context' in value: contexts[textdictid[0]][textdictid] = value['context']
+        if 'descriptions' in value: descriptions[textdictid[0]][textdictid] = value['descriptions']
+    deps = DependencyGraph(adjacency, contexts, descriptions, dep_depth)
+    for mid in adj:
+        context_children, description_children = deps.children(mid)
+        if context_children or description_children:
+            writer.add(make_key(paperpath, mid), {'context_children': context_children, 'description_children': description_children})
+    writer.add(make_key(paperpath, DEPENDENCIES), dep_depth)
+
+if __name__ == '__main__':
+    from indexer import encoders, read_papers
+    parser = argparse.ArgumentParser(description='Build the context/description sidecar of a list of papers.')
+    parser.add_argument('sidecar', help='file to write')
+    parser.add_argument('papers', help='file listing the papers (e.g. 1/0704.0097.txt), one per line; - for stdin')
+    parser.add_argument('-e', '--encoder', choices=sorted(encoders), default='paragraph', help='encoder whose input directories are read')
+    parser.add_argument('--dep-depth', type=int, help='also store the children texts of every formula, up to this many levels of math_adj')
+    args = parser.parse_args()
+    module = __import__(encoders[args.encoder])
+    writer = SidecarWriter(args.sidecar)
+    errors = 0
+    for filepath in read_papers(args.papers):
+        try:
+            add_paper(writer, module, filepath, args.dep_depth)
+        except Exception as e:
+            errors += 1
+            sys.stderr.write('%s error: %s\n' % (filepath, e))
+    writer.close()
+    sys.exit(1 if errors else 0)
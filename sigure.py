@@ -1,13 +1,35 @@
 #! /usr/bin/env python
 
 from xml.dom import minidom
-from ctypes import c_longlong
 from mathml import cut_nomeaning_text, parse_file
+from symhash import symbol_hash
+
+MASK = 0xFFFFFFFFFFFFFFFF
+SIGN = 0x8000000000000000
+ORDER_HASHES = [] # ORDER_HASHES[i] : symbol_hash(str(i)) & MASK
+
+def to_longlong(x):
+    # x : integer.
+    # returns : x wrapped to a signed 64 bit int, same as c_longlong(x).value.
+    x &= MASK
+    if x & SIGN: return int(x - (MASK + 1))
+    return int(x)
+
+def order_hash(i):
+    # i : order of a variable.
+    # returns : symbol_hash(str(i)) as an unsigned 64 bit int.
+    while len(ORDER_HASHES) <= i:
+        ORDER_HASHES.append(symbol_hash(str(len(ORDER_HASHES))) & MASK)
+    return ORDER_HASHES[i]
+
+class HashResult(object):
+    # constant and coefs are kept as unsigned 64 bit ints (arithmetic is modulo 2 ** 64);
+    # value() returns the signed value.
+    __slots__ = ('constant', 'coef', 'order')
 
-class HashResult:
     def __init__(self, value = 0, var_name = None):
         assert type(value) == int
-        self.constant = value
+        self.constant = value & MASK
         if var_name:
             self.coef = {var_name: 1}
             self.order = {var_name: 0}
@@ -15,36 +37,45 @@ class HashResult:
             self.coef = dict()
             self.order = dict()
 
+    def rebase(self, constant):
+        # drops the coefs and sets the constant, keeping the order of the variables.
+        self.constant = constant & MASK
+        self.coef = dict()
+
     def merge(self, a, op):
         # a must be odd
-        a |= 1
+        a = (a | 1) & MASK
 
         # a * self + op
-        for key in self.coef:
-            self.coef[key] = c_longlong(self.coef[key] * a).value
-        self.constant = c_longlong(self.constant * a).value
-        for key in op.coef:
-            self.coef[key] = c_longlong(self.coef.get(key, 0) + op.coef[key]).value
-        self.constant = c_longlong(self.constant + op.constant).value    
-
-        # merge order
-        for key in op.order:
-            if key not in self.order:
-                self.order[key] = len(self.order)
+        coef = self.coef
+        for key in coef:
+            coef[key] = coef[key] * a & MASK
+        self.constant = (self.constant * a + op.constant) & MASK
+        for key, c in op.coef.iteritems():
+            coef[key] = (coef.get(key, 0) + c) & MASK
+
+        # merge order: the variables new to self follow, in their order in op
+        # (not in dict order, which depends on the string hash)
+        order = self.order
+        new = [key for key in op.order if key not in order]
+        if len(new) > 1: new.sort(key=op.order.get)
+        for key in new:
+            order[key] = len(order)
 
     def value(self):
         value = self.constant
-        for key in self.coef:
-            value = c_longlong(value + self.coef[key] * hash(str(self.order[key]))).value
-        return value
+        order = self.order
+        for key, c in self.coef.iteritems():
+            value += c * order_hash(order[key])
+        return to_longlong(value)
 
 def hash_leaf(mml_elem):
     # mml_elem : minidom mml element that has no children.
     # returns : hash value singleton.x
     if mml_elem.nodeType == mml_elem.TEXT_NODE:
-        var = hash(mml_elem.data)
+        var = symbol_hash(mml_elem.data)
     else:
-        var = hash(mml_elem.localName)
+        var = symbol_hash(mml_elem.localName)
     return HashResult(value = var), [var]
 
 def hash_qvar(mml_elem):
@@ -71,8 +102,7 @@ def hash_apply(mml_elem, args):
 
     op_var, op_args = args[0].value(), args[1:]
     result = args[0]
-    result.constant = op_var
-    result.coef = dict()
+    result.rebase(op_var)
     for arg in op_args:
         result.merge(op_var, arg)
     return result
@@ -81,28 +111,47 @@ def hash_node(mml_elem, args):
     # mml_elem : minidom mml internal node.
     # args : hash values from children nodes.
     # returns : hashed value
-    a, b = c_longlong(hash(mml_elem.localName[0::2])).value, c_longlong(hash(mml_elem.localName[1::2])).value
+    a, b = to_longlong(symbol_hash(mml_elem.localName[0::2])), to_longlong(symbol_hash(mml_elem.localName[1::2]))
     result = HashResult(value = b)
     for arg in args:
         result.merge(a, arg)
     return result
 
-def hash_recursion(mml_elem):
+def hash_enter(mml_elem):
     # mml_elem : minidom mml element object.
-    # returns : hash value set for the subtree rooted at mml_elem.
+    # returns : hash result and value singleton of a node hashed without its children, or None.
     if mml_elem.localName == "qvar" : return hash_qvar(mml_elem)
     if mml_elem.localName in ["mi", "ci"] : return hash_mi(mml_elem)
     if not mml_elem.hasChildNodes(): return hash_leaf(mml_elem)
+    return None
 
-    args, subs = [], []
-    for childNode in mml_elem.childNodes:
-        arg, sub = hash_recursion(childNode)
-        args.append(arg)
-        subs += sub
-    if mml_elem.localName == "apply" : result = hash_apply(mml_elem, args)        
-    else: result = hash_node(mml_elem, args)
-
-    return result, subs + [result.value()]
+def hash_recursion(mml_elem):
+    # mml_elem : minidom mml element object.
+    # returns : hash value set for the subtree rooted at mml_elem.
+    # walks the tree with an explicit stack of (internal node, children iterator, args).
+    leaf = hash_enter(mml_elem)
+    if leaf is not None: return leaf
+
+    res = []
+    stack = [(mml_elem, iter(mml_elem.childNodes), [])]
+    while stack:
+        elem, children, args = stack[-1]
+        childNode = next(children, None)
+        if childNode is not None:
+            leaf = hash_enter(childNode)
+            if leaf is None:
+                stack.append((childNode, iter(childNode.childNodes), []))
+            else:
+                args.append(leaf[0])
+                res.extend(leaf[1])
+            continue
+        stack.pop()
+        if elem.localName == "apply" : result = hash_apply(elem, args)
+        else: result = hash_node(elem, args)
+        res.append(result.value())
+        if stack: stack[-1][2].append(result)
+
+    return result, res
 
 def hash_mml(mml):
     # mml : minidom mml object (top is m:math or math).
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+from multiprocessing.pool import ThreadPool
+import requests
+
+class SnuggleClient:
+    '''
+    Client for the Snuggle upconvert servlet (<url>/upconvert/upconvert).
+
+    Requests share a keep-alive connection pool and carry a timeout. The
+    servlet takes one formula per request, so batching is done on the client:
+    enrich_many sends a whole batch of formulas concurrently, with at most
+    max_in_flight requests outstanding.
+
+    A failed request (connection error, timeout) is reported with status
+    code None, so callers can fall back to the un-enriched MathML exactly as
+    they do for a non-200 response.
+    '''
+    def __init__(self, url, max_in_flight=8, timeout=(5, 30)):
+        self.url = url + '/upconvert/upconvert'
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.max_in_flight = max_in_flight
+        self.__pool = None
+
+    def enrich(self, mathml):
+        '''
+        return status code and enriched mathml (utf-8), or (None, None) if the request failed
+        '''
+        try:
+            response = self.session.post(self.url, {"q": mathml}, timeout=self.timeout)
+        except requests.RequestException:
+            return None, None
+        return response.status_code, response.text.encode('utf-8')
+
+    def enrich_many(self, mathmls):
+        '''
+        same as enrich for every mathml, results in the same order
+        '''
+        if len(mathmls) <= 1 or self.max_in_flight <= 1:
+            return [self.enrich(mathml) for mathml in mathmls]
+        if self.__pool is None:
+            self.__pool = ThreadPool(self.max_in_flight)
+        return self.__pool.map(self.enrich, mathmls)
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+        self.session.close()
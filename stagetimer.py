@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+'''
+Stage timers and counters for encode_file.
+
+The encoders time their stages (reading math_new/math_adj, getDep, context
+and description extraction, parsing and enrichment, presentation and
+content paths, hashing, MinHash signatures, uploading) and count what they
+produce (formulas, cache hits, paths, hash values, documents) on a StageTimer, one per paper:
+
+    timer = StageTimer()
+    with timer.stage('read'):
+        ...
+    timer.count('formulas', len(mathlns))
+
+and the indexer turns it into a per-paper JSON record (record()), summed
+over the run by StageTotals and written in the Prometheus text format.
+
+When timing is off the encoders get NULL_TIMER, whose stage() returns a
+shared no-op context and whose count() does nothing; code that has to
+compute what it counts checks timer.enabled first.
+'''
+import os
+import time
+
+class Stage(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.add(self.name, time.time() - self.start)
+
+class StageTimer(object):
+    enabled = True
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    def stage(self, name):
+        '''
+        return a context manager adding the time spent in the block to stage name
+        '''
+        return Stage(self, name)
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def timed(self, name, function):
+        '''
+        return function, with the time of its calls added to stage name
+        '''
+        def timed_function(*args):
+            with self.stage(name):
+                return function(*args)
+        return timed_function
+
+    def iterate(self, name, iterable):
+        '''
+        yield the items of iterable, adding the time spent getting them to stage name
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            finally:
+                self.add(name, time.time() - start)
+            yield item
+
+    def record(self, **fields):
+        '''
+        return the timers and counters as a JSON-serializable dictionary, with fields
+        '''
+        record = dict(fields)
+        record['seconds'] = dict(self.seconds)
+        record['counts'] = dict(self.counts)
+        return record
+
+class NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+class NullTimer(object):
+    enabled = False
+    stage_context = NullStage()
+
+    def stage(self, name):
+        return self.stage_context
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def timed(self, name, function):
+        return function
+
+    def iterate(self, name, iterable):
+        return iterable
+
+NULL_TIMER = NullTimer()
+
+class StageTotals:
+    '''
+    Sum of the per-paper records of a run, written in the Prometheus text
+    exposition format (counters labelled with the encoder and the stage).
+    '''
+    def __init__(self, encoder, prefix='mcat'):
+        self.encoder = encoder
+        self.prefix = prefix
+        self.papers = {}
+        self.seconds = {}
+        self.counts = {}
+
+    def add(self, record, status):
+        self.papers[status] = self.papers.get(status, 0) + 1
+        for name, seconds in record.get('seconds', {}).iteritems():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        for name, n in record.get('counts', {}).iteritems():
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def __metric(self, lines, name, help, values, label=None):
+        name = '%s_%s' % (self.prefix, name)
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s counter' % name)
+        for key, value in sorted(values.iteritems()):
+            labels = 'encoder="%s"' % self.encoder
+            if label is not None:
+                labels += ',%s="%s"' % (label, key)
+            lines.append('%s{%s} %s' % (name, labels, repr(value)))
+
+    def prometheus(self):
+        lines = []
+        self.__metric(lines, 'papers_total', 'Papers encoded, by status.', self.papers, 'status')
+        self.__metric(lines, 'stage_seconds_total', 'Time spent in each encode_file stage.', self.seconds, 'stage')
+        for name, n in sorted(self.counts.iteritems()):
+            self.__metric(lines, '%s_total' % name, 'Number of %s.' % name.replace('_', ' '), {None: n})
+        return '\n'.join(lines) + '\n'
+
+    def write(self, promfile):
+        '''
+        write the totals to promfile, replacing it atomically (e.g. for the node exporter textfile collector)
+        '''
+        with open(promfile + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.rename(promfile + '.tmp', promfile)
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+# stable hash of the tag names and texts of mathml nodes.
+# python's hash() depends on the interpreter build and on hash randomization
+# (-R), so the values of different processes or machines may not match.
+# symbol_hash is the first 8 bytes of the md5 of the utf-8 text, as a signed
+# 64 bit int (the range of hash() on 64 bit builds). the mathml vocabulary and
+# frequent tokens are hashed once at import, other symbols when first seen
+# (up to MAX_SYMBOLS of them).
+
+import hashlib
+import struct
+
+MAX_SYMBOLS = 1 << 18
+
+PRESENTATION_TAGS = ["math", "semantics", "annotation", "annotation-xml",
+    "mi", "mn", "mo", "ms", "mtext", "mspace", "mglyph",
+    "mrow", "mfrac", "msqrt", "mroot", "mstyle", "merror", "mpadded", "mphantom", "mfenced", "menclose",
+    "msub", "msup", "msubsup", "munder", "mover", "munderover", "mmultiscripts", "mprescripts", "none",
+    "mtable", "mtr", "mtd", "mlabeledtr", "maligngroup", "malignmark", "maction"]
+
+CONTENT_TAGS = ["apply", "ci", "cn", "csymbol", "cerror", "cs", "cbytes", "bind", "bvar", "share", "qvar",
+    "lowlimit", "uplimit", "degree", "logbase", "momentabout", "condition", "domainofapplication",
+    "interval", "set", "list", "vector", "matrix", "matrixrow", "piecewise", "piece", "otherwise",
+    "plus", "minus", "times", "divide", "power", "root", "quotient", "rem", "factorial", "abs", "conjugate",
+    "eq", "neq", "lt", "gt", "leq", "geq", "approx", "equivalent", "factorof", "tendsto",
+    "and", "or", "xor", "not", "implies", "forall", "exists",
+    "in", "notin", "subset", "prsubset", "notsubset", "union", "intersect", "setdiff", "card",
+    "int", "sum", "product", "limit", "diff", "partialdiff", "compose", "inverse",
+    "sin", "cos", "tan", "exp", "ln", "log", "max", "min", "floor", "ceiling",
+    "infinity", "pi", "exponentiale", "imaginaryi", "emptyset", "integers", "reals", "naturalnumbers"]
+
+TOKENS = ["superscript", "subscript", "ambiguous", "absent", "times", "plus", "minus", "divide",
+    "=", "+", "-", "*", "/", "(", ")", "[", "]", "{", "}", "|", ",", ".", ":", ";", "!", "<", ">", "^", "_",
+    u"\u2212", u"\u00d7", u"\u22c5", u"\u2062", u"\u2061", u"\u2063", u"\u2264", u"\u2265", u"\u2260",
+    u"\u2208", u"\u2211", u"\u222b", u"\u221e", u"\u2202", u"\u2192", u"\u2032", u"\u25ef", u"\u25fb",
+    ""] + [chr(c) for c in range(ord('a'), ord('z') + 1)] + [chr(c) for c in range(ord('A'), ord('Z') + 1)] \
+    + [unichr(c) for c in range(0x3b1, 0x3ca)] + [str(i) for i in range(100)]
+
+def md5_hash(sym):
+    # sym : tag name or text (str or unicode).
+    # returns : first 8 bytes of the md5 of sym as a signed 64 bit int.
+    if isinstance(sym, unicode):
+        sym = sym.encode('utf-8')
+    return struct.unpack('<q', hashlib.md5(sym).digest()[:8])[0]
+
+# hash of the name of comments and processing instructions (hashing.etree_name)
+NONE_HASH = md5_hash('\0None')
+
+def vocabulary():
+    # returns : symbols hashed at import; sigure also hashes the halves of tag names.
+    for tag in PRESENTATION_TAGS + CONTENT_TAGS:
+        yield tag
+        yield tag[0::2]
+        yield tag[1::2]
+    for token in TOKENS:
+        yield token
+
+TABLE = dict((sym, md5_hash(sym)) for sym in vocabulary())
+TABLE[None] = NONE_HASH
+
+def symbol_hash(sym):
+    # sym : tag name or text, or None.
+    # returns : stable hash value of sym, used instead of hash(sym).
+    var = TABLE.get(sym)
+    if var is None:
+        var = md5_hash(sym)
+        if len(TABLE) < MAX_SYMBOLS:
+            TABLE[sym] = var
+    return var
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# vim: sts=4:ts=4:sw=4
+import json
+import threading
+import time
+import Queue
+
+class UploadError(Exception):
+    pass
+
+class BatchUploader:
+    '''
+    Buffered replacement for solr.SolrConnection.add_many.
+
+    Documents are grouped into batches of at most max_docs documents and
+    max_bytes (approximate, JSON-serialized) bytes, across calls, paragraphs
+    and papers. Full batches are sent by a background thread; at most
+    max_pending batches wait for it, so producers block when Solr falls
+    behind. When the smoothed add_many latency rises above latency_target
+    seconds, producers are additionally delayed by the excess before
+    handing over a batch.
+
+    commit_every commits after that many uploaded documents (0: never);
+    commit_on_close commits when the uploader is closed. Errors raised by
+    the background thread are re-raised as UploadError by the next add,
+    flush or close. Until then the batches and delete queries that reach the
+    thread are dropped, not sent after a failed one; the UploadError counts
+    them, and docs_dropped the documents lost in all. delete_query is sent in
+    order with the batches.
+
+        uploader = BatchUploader(solr.SolrConnection(url), max_docs=500)
+        encode_file(filepath, uploader)
+        uploader.close()
+    '''
+    def __init__(self, solr, max_docs=500, max_bytes=8 * 1024 * 1024, max_pending=4,
+                 commit_every=0, commit_on_close=True, latency_target=2.0, max_delay=10.0):
+        self.solr = solr
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.commit_on_close = commit_on_close
+        self.latency_target = latency_target
+        self.max_delay = max_delay
+        self.latency = 0.0 # exponentially smoothed seconds per add_many
+        self.docs_uploaded = 0
+        self.bytes_uploaded = 0
+        self.bytes_added = 0 # includes the buffered and pending documents
+        self.docs_dropped = 0
+        self.error = None
+        self.closed = False
+        self.__buffer = []
+        self.__buffer_bytes = 0
+        self.__uncommitted = 0
+        self.__dropped = [0, 0, 0] # batches, documents and delete queries dropped since the error
+        self.__lock = threading.Lock()
+        self.__queue = Queue.Queue(max_pending)
+        self.__thread = threading.Thread(target=self.__send_loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __doc_size(self, doc):
+        return len(json.dumps(doc))
+
+    def __check(self):
+        with self.__lock:
+            if self.error is None:
+                return
+            error, self.error = self.error, None
+            batches, docs, queries = self.__dropped
+            self.__dropped = [0, 0, 0]
+        if batches or queries:
+            error += ' (then dropped %d batches of %d documents and %d delete queries)' % (batches, docs, queries)
+        raise UploadError(error)
+
+    def __send_loop(self):
+        while True:
+            batch = self.__queue.get()
+            try:
+                if batch is None:
+                    return
+                docs, size, query = batch
+                with self.__lock:
+                    if self.error is not None:
+                        #not sent after a failed batch: counted in the error raised by __check
+                        self.__dropped[0] += 1 if query is None else 0
+                        self.__dropped[1] += len(docs)
+                        self.__dropped[2] += 1 if query is not None else 0
+                        self.docs_dropped += len(docs)
+                        continue
+                lost = len(docs)
+                if query is not None:
+                    self.solr.delete_query(query)
+                else:
+                    start = time.time()
+                    self.solr.add_many(docs)
+                    lost = 0
+                    self.latency = 0.8 * self.latency + 0.2 * (time.time() - start)
+                    self.docs_uploaded += len(docs)
+                    self.bytes_uploaded += size
+                    self.__uncommitted += len(docs)
+                    if self.commit_every and self.__uncommitted >= self.commit_every:
+                        self.solr.commit()
+                        self.__uncommitted = 0
+            except Exception as e:
+                with self.__lock:
+                    self.error = '%s: %s' % (type(e).__name__, e)
+                    if query is not None:
+                        self.error += ' (delete query %s)' % query
+                    elif lost:
+                        self.error += ' (batch of %d documents)' % lost
+                    self.docs_dropped += lost
+            finally:
+                self.__queue.task_done()
+
+    def __enqueue(self):
+        if not self.__buffer:
+            return
+        excess = self.latency - self.latency_target
+        if excess > 0:
+            time.sleep(min(excess, self.max_delay))
+        self.__queue.put((self.__buffer, self.__buffer_bytes, None))
+        self.__buffer = []
+        self.__buffer_bytes = 0
+
+    def add(self, doc):
+        self.__check()
+        size = self.__doc_size(doc)
+        if self.__buffer and (len(self.__buffer) >= self.max_docs or self.__buffer_bytes + size > self.max_bytes):
+            self.__enqueue()
+        self.__buffer.append(doc)
+        self.__buffer_bytes += size
+        self.bytes_added += size
+
+    def add_many(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    def delete_query(self, query):
+        '''
+        delete the documents matching query, after the documents added so far
+        '''
+        self.__check()
+        self.__enqueue()
+        self.__queue.put(([], 0, query))
+
+    def flush(self):
+        '''
+        send the buffered documents and wait until every batch is uploaded
+        '''
+        self.__enqueue()
+        self.__queue.join()
+        self.__check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+            if self.commit_on_close:
+                self.solr.commit()
+        finally:
+            self.__queue.put(None)
+            self.__thread.join()